@@ -13,11 +13,12 @@ class AddTask(object):
         self.nout = 1
         self.classifType = 'lastLinear'
 
-    def generate(self, batchsize, length):
-        l = self.rng.randint(int(length*0.1)) + length
-        p0 = self.rng.randint(int(l*0.1), size=(batchsize,))
-        p1 = self.rng.randint(int(l*0.4), size=(batchsize,)) + int(l*0.1)
-        data = self.rng.uniform(size=(l, batchsize, 2)).astype(self.floatX)
+    def generate(self, batchsize, length, rng=None):
+        rng = self.rng if rng is None else rng
+        l = rng.randint(int(length*0.1)) + length
+        p0 = rng.randint(int(l*0.1), size=(batchsize,))
+        p1 = rng.randint(int(l*0.4), size=(batchsize,)) + int(l*0.1)
+        data = rng.uniform(size=(l, batchsize, 2)).astype(self.floatX)
         data[:,:,0] = 0.
         data[p0, np.arange(batchsize), np.zeros((batchsize,),
                                                 dtype='int32')] = 1.
@@ -0,0 +1,290 @@
+"""
+Binary cache for the MNIST CSV files.
+
+The first load of a CSV parses it once and writes the values to a .npy
+file in <data folder>/cache/, together with the SHA-256 hash, size and
+modification time of the CSV. Later loads open the .npy with np.memmap
+and skip the parse. The cache is rebuilt when the CSV changes or is
+asked for with another dtype or layout, and it keeps working when the
+CSV has been removed.
+
+Images are stored in the (seq_length, n_samples, 1) layout that SRNN
+reads, so opening them needs no further copies. The same layout is used
+by the sharded data sets that mnist_generator.py writes, which
+load_shards opens without any CSV at all.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+CACHE_DIR = "cache"
+SHARD_INDEX = "index.json"
+
+
+def file_sha256(path, block=1 << 20):
+    """
+    SHA-256 hex digest of the file at *path*, read *block* bytes at a time.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(block), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _cache_paths(csv_path):
+    folder, name = os.path.split(csv_path)
+    base = os.path.join(folder, CACHE_DIR, os.path.splitext(name)[0])
+    return base + ".npy", base + ".json"
+
+
+def _source_info(csv_path):
+    st = os.stat(csv_path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def _cache_is_valid(csv_path, npy_path, meta_path, dtype, sequence):
+    if not (os.path.exists(npy_path) and os.path.exists(meta_path)):
+        return False
+    with open(meta_path) as f:
+        meta = json.load(f)
+    # a cache written for another dtype or layout is rebuilt
+    if meta.get("dtype") != np.dtype(dtype).str:
+        return False
+    if (len(meta.get("shape", ())) == 3) != bool(sequence):
+        return False
+    if not os.path.exists(csv_path):
+        return True
+    info = _source_info(csv_path)
+    if all(meta.get(k) == v for k, v in info.items()):
+        return True
+    # the file was touched, only its content decides
+    if meta.get("sha256") != file_sha256(csv_path):
+        return False
+    meta.update(info)
+    with open(meta_path, "w") as f:
+        json.dump(meta, f, indent=1)
+    return True
+
+
+def _write_cache(csv_path, npy_path, meta_path, dtype, sequence):
+    values = pd.read_csv(
+        csv_path, header=None, dtype=np.float64, float_precision="round_trip"
+    ).to_numpy()
+    if sequence:
+        # (n_samples, seq_length) rows become (seq_length, n_samples, 1)
+        shape = (values.shape[1], values.shape[0], 1)
+    else:
+        shape = (values.size,)
+
+    os.makedirs(os.path.dirname(npy_path), exist_ok=True)
+    tmp = npy_path + ".tmp"
+    out = np.lib.format.open_memmap(tmp, mode="w+", dtype=dtype, shape=shape)
+    if sequence:
+        out[:, :, 0] = values.T
+    else:
+        out[:] = values.reshape(-1)
+    out.flush()
+    del out
+    os.replace(tmp, npy_path)
+
+    meta = {
+        "source": os.path.basename(csv_path),
+        "sha256": file_sha256(csv_path),
+        "dtype": np.dtype(dtype).str,
+        "shape": list(shape),
+    }
+    meta.update(_source_info(csv_path))
+    with open(meta_path, "w") as f:
+        json.dump(meta, f, indent=1)
+
+
+def load_csv_cached(csv_path, dtype=np.float32, sequence=False):
+    """
+    Loads a numeric CSV file through the binary cache.
+
+    Parameters
+    ----------
+    csv_path : path of the CSV file
+    dtype    : dtype of the cached values
+    sequence : if True every row is a sequence and the result has the shape
+               (n_columns, n_rows, 1), otherwise the values are flattened
+
+    A cache written for another dtype or layout is rebuilt.
+
+    Returns
+    -------
+    numpy.memmap
+        Read-only memory-mapped values from the cache
+    """
+    npy_path, meta_path = _cache_paths(csv_path)
+    if not _cache_is_valid(csv_path, npy_path, meta_path, dtype, sequence):
+        _write_cache(csv_path, npy_path, meta_path, dtype, sequence)
+    return np.load(npy_path, mmap_mode="r")
+
+
+def has_shards(folder):
+    """
+    True if *folder* holds a sharded data set written by mnist_generator.py.
+    """
+    return os.path.exists(os.path.join(folder, SHARD_INDEX))
+
+
+def load_shard_index(folder):
+    """
+    The index.json of a sharded data set written by mnist_generator.py.
+    """
+    with open(os.path.join(folder, SHARD_INDEX)) as f:
+        return json.load(f)
+
+
+def load_shards(folder, split, verify=False):
+    """
+    Loads one split of a sharded data set written by mnist_generator.py.
+
+    Parameters
+    ----------
+    folder : directory with index.json and the shards
+    split  : "train" or "test"
+    verify : if True the SHA-256 of every shard is checked against the index
+
+    Returns
+    -------
+    X : images of shape (seq_length, n_samples, 1), memory-mapped if the
+        split has a single shard
+    y : integer labels of shape (n_samples,), memory-mapped likewise
+    """
+    shards = load_shard_index(folder)["splits"][split]["shards"]
+    if verify:
+        for shard in shards:
+            for key in ("x", "y"):
+                if file_sha256(os.path.join(folder, shard[key])) != shard[key + "_sha256"]:
+                    raise Exception("Unsupported shard, checksum mismatch: %s" % shard[key])
+
+    X = [np.load(os.path.join(folder, s["x"]), mmap_mode="r") for s in shards]
+    y = [np.load(os.path.join(folder, s["y"]), mmap_mode="r") for s in shards]
+    if len(shards) == 1:
+        return X[0], y[0]
+    return np.concatenate(X, axis=1), np.concatenate(y)
+
+
+class StreamingDataset(object):
+    """
+    Sequence data set that is read from disk in fixed-size chunks of records
+    instead of being loaded whole.
+
+    A record is one sequence and its class label. The sequences are read
+    from a CSV file with one sequence of seq_length * n_inp values per row,
+    or from a .npy file in the (seq_length, n_records, n_inp) layout of the
+    cache above, and the integer labels (0 to n_classes - 1) from a CSV or
+    .npy file with one label per record. batches() reads chunk_records
+    records at a time, shuffles them within a buffer of shuffle_buffer
+    further records and cuts the result into minibatches, so memory stays
+    bounded by (chunk_records + shuffle_buffer) records whatever the size
+    of the files.
+
+    It has the shape, ndim and dtype of the (seq_length, n_records, n_inp)
+    array it stands for, and can be passed to SRNN as X (with y=None) or as
+    X_test.
+    """
+
+    def __init__(self, x_path, y_path, n_classes=10, n_inp=1, chunk_records=4096,
+                 shuffle_buffer=0, seed=None, dtype=np.float32):
+        self.x_path = x_path
+        self.y_path = y_path
+        self.n_classes = n_classes
+        self.n_inp = n_inp
+        self.chunk_records = chunk_records
+        self.shuffle_buffer = shuffle_buffer
+        self.rng = np.random.RandomState(seed)
+        self.dtype = np.dtype(dtype)
+
+        if x_path.endswith(".npy"):
+            seq_length, n_records = np.load(x_path, mmap_mode="r").shape[:2]
+        else:
+            first = pd.read_csv(x_path, header=None, nrows=1)
+            seq_length = first.shape[1] // n_inp
+            n_records = None
+        if y_path.endswith(".npy"):
+            n_labels = len(np.load(y_path, mmap_mode="r"))
+        else:
+            with open(y_path, "rb") as f:
+                n_labels = sum(1 for line in f if line.strip())
+        self.shape = (seq_length, min(n_labels, n_records or n_labels), n_inp)
+        self.ndim = 3
+
+    def __len__(self):
+        return self.shape[1]
+
+    def _x_chunks(self):
+        # record-major (n, seq_length, n_inp) chunks
+        c = self.chunk_records
+        if self.x_path.endswith(".npy"):
+            X = np.load(self.x_path, mmap_mode="r")
+            for i in range(0, X.shape[1], c):
+                yield np.asarray(X[:, i : i + c], dtype=self.dtype).transpose(1, 0, 2)
+        else:
+            for chunk in pd.read_csv(self.x_path, header=None, chunksize=c, dtype=self.dtype):
+                yield chunk.to_numpy().reshape(len(chunk), -1, self.n_inp)
+
+    def _y_chunks(self):
+        c = self.chunk_records
+        if self.y_path.endswith(".npy"):
+            y = np.load(self.y_path, mmap_mode="r")
+            for i in range(0, len(y), c):
+                yield np.asarray(y[i : i + c], dtype=np.int64)
+        else:
+            for chunk in pd.read_csv(self.y_path, header=None, chunksize=c):
+                yield chunk.to_numpy(dtype=np.int64).reshape(-1)
+
+    def records(self, shuffle=True):
+        """
+        Yields (sequences, labels) chunks of records, with the sequences in
+        record-major (n, seq_length, n_inp) layout. With shuffle (and a
+        shuffle buffer) every chunk is drawn at random from the records
+        read so far that have not been yielded yet.
+        """
+        buffer_x = buffer_y = None
+        for x, y in zip(self._x_chunks(), self._y_chunks()):
+            n = min(len(x), len(y))
+            x, y = x[:n], y[:n]
+            if not (shuffle and self.shuffle_buffer):
+                yield x, y
+                continue
+            if buffer_x is not None:
+                x = np.concatenate([buffer_x, x])
+                y = np.concatenate([buffer_y, y])
+            order = self.rng.permutation(len(x))
+            x, y = x[order], y[order]
+            keep = min(self.shuffle_buffer, len(x))
+            buffer_x, buffer_y = x[:keep], y[:keep]
+            if len(x) > keep:
+                yield x[keep:], y[keep:]
+        if buffer_x is not None and len(buffer_x):
+            yield buffer_x, buffer_y
+
+    def batches(self, batch_size, shuffle=True, partial=False):
+        """
+        Yields minibatches (x, y) of batch_size records: x of shape
+        (seq_length, batch_size, n_inp) and the integer class labels y of
+        shape (batch_size,). A last incomplete minibatch is dropped,
+        unless *partial* is set.
+        """
+        pending_x = pending_y = None
+        for x, y in self.records(shuffle):
+            if pending_x is not None:
+                x = np.concatenate([pending_x, x])
+                y = np.concatenate([pending_y, y])
+            n = len(x) - len(x) % batch_size
+            for i in range(0, n, batch_size):
+                yield self._batch(x[i : i + batch_size], y[i : i + batch_size])
+            pending_x, pending_y = x[n:], y[n:]
+        if partial and pending_x is not None and len(pending_x):
+            yield self._batch(pending_x, pending_y)
+
+    def _batch(self, x, y):
+        # (seq_length, batch, n_inp) inputs of records x, with their labels
+        return np.ascontiguousarray(x.transpose(1, 0, 2)), y
@@ -1,47 +1,152 @@
-from sklearn.datasets import load_digits
-import pandas as pd
-from sklearn.model_selection import train_test_split
+"""
+Builds the 8x8 MNIST data set used by tptt_mnist_no_auto_grad_no_torch.py.
+
+The train and test splits of MNIST8_group.npy are written as typed .npy
+shards in the (64, n_samples, 1) layout that SRNN reads, next to an
+index.json with the size, dtype and SHA-256 of every shard. The shards
+are written by a pool of worker processes, and load_MNIST (through
+mnist_data.load_shards) memory-maps them directly.
+
+Usage:
+    python mnist_generator.py --source MNIST8_group.npy --out mnist_8x8
+    python mnist_generator.py --sample_train 10000 --sample_test 2000 --seed 1
+"""
+
+import os
+import sys
+import json
+import argparse
 import numpy as np
-import scipy.io
-mnist = load_digits()
-
-# data_set = scipy.io.loadmat('MNIST_TrainSet_0to1_8x8pixel.mat')     #MNIST dataset in 8x8 resolution
-# data = data_set['number']
-# label_set = scipy.io.loadmat('MNIST_TrainSet_Label.mat')
-# label = label_set['label']
-# data = data.T
-# label = label.T
-
-loaded_data = np.load('MNIST8_group.npy', allow_pickle=True).item()
-train_data = loaded_data['train_X']
-train_labels = loaded_data['train_y']
-test_data = loaded_data['test_X']
-test_labels = loaded_data['test_y']
-x_train = pd.DataFrame(train_data)
-y_train = pd.DataFrame(train_labels)
-x_test = pd.DataFrame(test_data)
-y_test = pd.DataFrame(test_labels)
-#breakpoint()
-#breakpoint()
-# x1 = pd.DataFrame(data)
-# y1 = pd.DataFrame(label)
-
-# x = pd.DataFrame(mnist.data)
-# y = pd.DataFrame(mnist.target)
-
-# import matplotlib.pyplot as plt
-# image0 = x1.iloc[0].to_numpy().reshape(8,8)
-# breakpoint()
-# plt.imshow(image0)
-# plt.show()
-# breakpoint()
-#x = x / 255.0
-
-train_size = 0.7
-#x_train, x_test, y_train, y_test = train_test_split(x1, y1, train_size=train_size)
-# breakpoint()
-#breakpoint()
-x_train.to_csv("mnist_8x8/train_X.csv", header=False, index=False)
-x_test.to_csv("mnist_8x8/test_X.csv", header=False, index=False)
-y_train.to_csv("mnist_8x8/train_Y.csv", header=False, index=False)
-y_test.to_csv("mnist_8x8/test_Y.csv", header=False, index=False)
\ No newline at end of file
+from multiprocessing import Pool
+
+from mnist_data import file_sha256, SHARD_INDEX
+
+SPLITS = ("train", "test")
+
+
+def _write_shard(job):
+    """
+    Writes one shard of a split and returns its index entry.
+
+    The images are stored as float32 in the (seq_length, n, 1) layout and
+    the labels as int32, each as a .npy file. With csv set, the rows are
+    also appended in CSV form to the shard's part of the old text files.
+    """
+    out_dir, split, shard, X, y, csv = job
+    x_name = "%s_X_%05d.npy" % (split, shard)
+    y_name = "%s_Y_%05d.npy" % (split, shard)
+    x_path = os.path.join(out_dir, x_name)
+    y_path = os.path.join(out_dir, y_name)
+
+    np.save(x_path, np.ascontiguousarray(X.T[:, :, None], dtype=np.float32))
+    np.save(y_path, y.astype(np.int32))
+    if csv:
+        np.savetxt(os.path.join(out_dir, "%s_X.csv.%05d" % (split, shard)), X, fmt="%.17g", delimiter=",")
+        np.savetxt(os.path.join(out_dir, "%s_Y.csv.%05d" % (split, shard)), y, fmt="%d")
+    return {
+        "x": x_name,
+        "y": y_name,
+        "n": len(y),
+        "x_sha256": file_sha256(x_path),
+        "y_sha256": file_sha256(y_path),
+    }
+
+
+def _join_csv(out_dir, split, n_shards):
+    # concatenates the per-shard CSV parts into <split>_X.csv / <split>_Y.csv
+    for name in ("%s_X.csv" % split, "%s_Y.csv" % split):
+        with open(os.path.join(out_dir, name), "wb") as out:
+            for shard in range(n_shards):
+                part = os.path.join(out_dir, "%s.%05d" % (name, shard))
+                with open(part, "rb") as f:
+                    out.write(f.read())
+                os.remove(part)
+
+
+def build(source, out_dir, shard_size=65536, workers=None, csv=False,
+          sample_train=0, sample_test=0, seed=1234):
+    """
+    Writes the train and test splits of *source* to sharded .npy files.
+
+    Parameters
+    ----------
+    source       : MNIST8_group.npy, a pickled dict with train_X, train_y,
+                   test_X and test_y
+    out_dir      : output directory, e.g. mnist_8x8
+    shard_size   : maximum number of samples per shard
+    workers      : number of worker processes, all CPUs by default
+    csv          : also write train_X.csv etc. for the scripts in old/
+    sample_train : if not 0, write only this many random training samples
+    sample_test  : if not 0, write only this many random test samples
+    seed         : seed of the sampling
+
+    Returns
+    -------
+    dict
+        The index that was written to out_dir/index.json
+    """
+    data = np.load(source, allow_pickle=True).item()
+    rng = np.random.RandomState(seed)
+    os.makedirs(out_dir, exist_ok=True)
+
+    jobs = []
+    for split, sample in zip(SPLITS, (sample_train, sample_test)):
+        X = np.asarray(data["%s_X" % split])
+        y = np.asarray(data["%s_y" % split]).reshape(-1)
+        if sample:
+            idx = rng.choice(len(X), sample, replace=False)
+            X, y = X[idx], y[idx]
+        for shard, start in enumerate(range(0, len(X), shard_size)):
+            end = start + shard_size
+            jobs.append((out_dir, split, shard, X[start:end], y[start:end], csv))
+
+    with Pool(workers) as pool:
+        entries = pool.map(_write_shard, jobs)
+
+    index = {
+        "source": os.path.basename(source),
+        "source_sha256": file_sha256(source),
+        "sample_train": sample_train,
+        "sample_test": sample_test,
+        "seed": seed,
+        "splits": {},
+    }
+    for split in SPLITS:
+        shards = [e for job, e in zip(jobs, entries) if job[1] == split]
+        index["splits"][split] = {
+            "n": sum(e["n"] for e in shards),
+            "seq_length": int(jobs[0][3].shape[1]),
+            "x_dtype": np.dtype(np.float32).str,
+            "y_dtype": np.dtype(np.int32).str,
+            "shards": shards,
+        }
+        if csv:
+            _join_csv(out_dir, split, len(shards))
+
+    with open(os.path.join(out_dir, SHARD_INDEX), "w") as f:
+        json.dump(index, f, indent=1)
+    return index
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Builds the sharded 8x8 MNIST data set.")
+    parser.add_argument("--source", help="Pickled source data", default="MNIST8_group.npy")
+    parser.add_argument("--out", help="Output directory", default="mnist_8x8")
+    parser.add_argument("--shard_size", help="Samples per shard", default=65536, type=int)
+    parser.add_argument("--workers", help="Worker processes", default=None, type=int)
+    parser.add_argument("--csv", help="Also write the CSV files", action="store_true")
+    parser.add_argument("--sample_train", help="Random training samples to keep", default=0, type=int)
+    parser.add_argument("--sample_test", help="Random test samples to keep", default=0, type=int)
+    parser.add_argument("--seed", help="Sampling seed", default=1234, type=int)
+    args = parser.parse_args(args[1:])
+
+    index = build(
+        args.source, args.out, args.shard_size, args.workers, args.csv,
+        args.sample_train, args.sample_test, args.seed,
+    )
+    for split, info in index["splits"].items():
+        print("%s: %i samples in %i shards" % (split, info["n"], len(info["shards"])))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -14,15 +14,19 @@ class PermTask(object):
         self.classifType = 'lastSoftmax'
         self.report = 'last'
 
-    def generate(self, batchsize, length):
-        randvals = self.rng.randint(98, size=(length+1, batchsize)) + 2
-        val = self.rng.randint(2, size=(batchsize,))
+    def generate(self, batchsize, length, as_index=False, rng=None):
+        # as_index returns uint8 symbols (length, batchsize) and class labels
+        rng = self.rng if rng is None else rng
+        randvals = rng.randint(98, size=(length+1, batchsize)) + 2
+        val = rng.randint(2, size=(batchsize,))
         randvals[numpy.zeros((batchsize,), dtype='int32'),
                  numpy.arange(batchsize)] = val
         randvals[numpy.ones((batchsize,), dtype='int32')*length,
                  numpy.arange(batchsize)] = val
         _targ = randvals[1:]
         _inp = randvals[:-1]
+        if as_index:
+            return _inp.astype(numpy.uint8), _targ[-1].astype(numpy.uint8)
         inp = numpy.zeros((length, batchsize, 100), dtype=self.floatX)
         # targ = numpy.zeros((length, batchsize, 100), dtype=self.floatX)
         targ = numpy.zeros((1, batchsize, 100), dtype=self.floatX)
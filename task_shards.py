@@ -0,0 +1,241 @@
+"""
+Pre-generated synthetic task data sets on disk.
+
+write_shards generates a training and a validation split of one of the
+pathological tasks once, batch by batch with task_utils.batch_rng, and
+writes the raw batches into shard files next to a small JSON index of the
+task, seeds, batch lengths and byte offsets. TaskShards reads them back as
+read-only memory-mapped arrays, so a training loop gets a batch without
+generating anything, and the validation split is byte-identical for every
+run that uses the same directory.
+
+Usage:
+    python task_shards.py --task perm --out shards/perm --batches 10000
+"""
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+from tempOrder import TempOrderTask
+from tempOrder3bit import TempOrder3bitTask
+from addition import AddTask
+from permutation import PermTask
+from task_utils import batch_rng
+
+TASKS = {
+    "temporal": TempOrderTask,
+    "temporal3": TempOrder3bitTask,
+    "addition": AddTask,
+    "perm": PermTask,
+}
+
+INDEX = "index.json"
+
+
+def _shard_name(split, shard):
+    return "%s-%05d.bin" % (split, shard)
+
+
+def _write_split(out_dir, task, split, seed, n_batches, batchsize, min_length,
+                 max_length, as_index, shard_bytes):
+    """
+    Writes one split and returns its index entries, one per batch.
+    """
+    def generate(k, batchsize):
+        rng = batch_rng(seed, k)
+        # the length is drawn from the batch's own stream, like the data
+        length = min_length + rng.randint(max_length - min_length + 1)
+        if as_index:
+            return task.generate(batchsize, length, as_index=True, rng=rng)
+        return task.generate(batchsize, length, rng=rng)
+
+    # dtypes of the split, also when it has no batches
+    x, y = generate(0, 1)
+    batches = []
+    shard, offset, f = 0, 0, None
+    for k in range(n_batches):
+        x, y = generate(k, batchsize)
+
+        if f is not None and offset + x.nbytes + y.nbytes > shard_bytes:
+            f.close()
+            shard, offset, f = shard + 1, 0, None
+        if f is None:
+            f = open(os.path.join(out_dir, _shard_name(split, shard)), "wb")
+
+        f.write(np.ascontiguousarray(x).tobytes())
+        f.write(np.ascontiguousarray(y).tobytes())
+        batches.append(
+            {
+                "shard": shard,
+                "offset": offset,
+                "x_shape": list(x.shape),
+                "y_shape": list(y.shape),
+            }
+        )
+        offset += x.nbytes + y.nbytes
+    if f is not None:
+        f.close()
+    return batches, x.dtype.str, y.dtype.str
+
+
+def write_shards(out_dir, task_name, seed, n_batches, batchsize, min_length,
+                 max_length, val_seed=None, val_batches=10, val_batchsize=1000,
+                 as_index=True, shard_bytes=256 << 20):
+    """
+    Generates a task data set and writes it to *out_dir*.
+
+    Parameters
+    ----------
+    out_dir       : directory for the shards and the index, created if needed
+    task_name     : one of TASKS
+    seed          : seed of the training split, batch k is generated with
+                    batch_rng(seed, k)
+    n_batches     : number of training batches
+    batchsize     : sequences per training batch
+    min_length    : minimal sequence length
+    max_length    : maximal sequence length, every batch has one length drawn
+                    from [min_length, max_length]
+    val_seed      : seed of the validation split, seed + 1 by default
+    val_batches   : number of validation batches
+    val_batchsize : sequences per validation batch
+    as_index      : store uint8 symbols and labels for the symbol tasks
+                    instead of one-hot arrays (ignored for addition)
+    shard_bytes   : approximate maximum size of a shard file
+
+    Returns
+    -------
+    dict
+        The index that was written to out_dir/index.json
+    """
+    if task_name not in TASKS:
+        raise Exception("Unsupported task.")
+    as_index = as_index and task_name != "addition"
+    if val_seed is None:
+        val_seed = seed + 1
+    os.makedirs(out_dir, exist_ok=True)
+
+    # the tasks only draw from the rng passed to generate here
+    task = TASKS[task_name](None, "float32")
+    index = {
+        "task": task_name,
+        "as_index": as_index,
+        "min_length": min_length,
+        "max_length": max_length,
+        "nin": task.nin,
+        "nout": task.nout,
+        "splits": {},
+    }
+    for split, s, n, b in (
+        ("train", seed, n_batches, batchsize),
+        ("valid", val_seed, val_batches, val_batchsize),
+    ):
+        batches, x_dtype, y_dtype = _write_split(
+            out_dir, task, split, s, n, b, min_length, max_length, as_index,
+            shard_bytes,
+        )
+        index["splits"][split] = {
+            "seed": s,
+            "batchsize": b,
+            "x_dtype": x_dtype,
+            "y_dtype": y_dtype,
+            "batches": batches,
+        }
+
+    with open(os.path.join(out_dir, INDEX), "w") as f:
+        json.dump(index, f, indent=1)
+    return index
+
+
+class TaskShards(object):
+    """
+    Random access to a data set written by write_shards.
+
+    Every shard file is memory-mapped once, and batch(split, k) returns
+    read-only views of batch k straight from the mapping, in the layout of
+    task.generate: inputs of shape (length, batchsize, nin), or (length,
+    batchsize) uint8 symbols if the set was written with as_index, and the
+    matching targets.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX)) as f:
+            self.index = json.load(f)
+        self.task = self.index["task"]
+        self.as_index = self.index["as_index"]
+        self.nin = self.index["nin"]
+        self.nout = self.index["nout"]
+        self.maps = {}
+
+    def __len__(self):
+        return self.n_batches("train")
+
+    def n_batches(self, split):
+        return len(self.index["splits"][split]["batches"])
+
+    def batch(self, split, k):
+        info = self.index["splits"][split]
+        entry = info["batches"][k]
+        buf = self._map(split, entry["shard"])
+        x_dtype = np.dtype(info["x_dtype"])
+        y_dtype = np.dtype(info["y_dtype"])
+        x_size = int(np.prod(entry["x_shape"])) * x_dtype.itemsize
+        y_size = int(np.prod(entry["y_shape"])) * y_dtype.itemsize
+        start = entry["offset"]
+        x = buf[start : start + x_size].view(x_dtype).reshape(entry["x_shape"])
+        y = buf[start + x_size : start + x_size + y_size].view(y_dtype)
+        return x, y.reshape(entry["y_shape"])
+
+    def batches(self, split="train", rng=None):
+        """
+        Yields the (x, y) batches of *split*, in the order they were
+        generated or shuffled with *rng*.
+        """
+        order = np.arange(self.n_batches(split))
+        if rng is not None:
+            rng.shuffle(order)
+        for k in order:
+            yield self.batch(split, k)
+
+    def _map(self, split, shard):
+        key = (split, shard)
+        if key not in self.maps:
+            self.maps[key] = np.memmap(
+                os.path.join(self.path, _shard_name(split, shard)), dtype=np.uint8, mode="r"
+            )
+        return self.maps[key]
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description="Pre-generates a pathological task data set into memory-mapped shards."
+    )
+    parser.add_argument("--task", help="Pathological task", choices=sorted(TASKS), required=True)
+    parser.add_argument("--out", help="Output directory", required=True)
+    parser.add_argument("--seed", help="Training split seed", default=1234, type=int)
+    parser.add_argument("--batches", help="Number of training batches", default=10000, type=int)
+    parser.add_argument("--batchsize", help="Size of the minibatch", default=20, type=int)
+    parser.add_argument("--min", help="Minimal length of the task", default=10, type=int)
+    parser.add_argument("--max", help="Maximal length of the task", default=10, type=int)
+    parser.add_argument("--val_seed", help="Validation split seed", default=None, type=int)
+    parser.add_argument("--val_batches", help="Number of validation batches", default=10, type=int)
+    parser.add_argument("--val_batchsize", help="Size of a validation batch", default=1000, type=int)
+    parser.add_argument("--one_hot", help="Store one-hot arrays instead of uint8 symbols",
+                        action="store_true")
+    args = parser.parse_args(args[1:])
+
+    index = write_shards(
+        args.out, args.task, args.seed, args.batches, args.batchsize, args.min,
+        args.max, args.val_seed, args.val_batches, args.val_batchsize,
+        as_index=not args.one_hot,
+    )
+    for split, info in index["splits"].items():
+        print("%s: %i batches of %i, seed %i" % (
+            split, len(info["batches"]), info["batchsize"], info["seed"]))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
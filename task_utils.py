@@ -0,0 +1,105 @@
+"""
+Helpers shared by the synthetic task generators.
+
+The symbol tasks (TempOrderTask, TempOrder3bitTask, PermTask) can return
+their sequences as uint8 symbol indices and their targets as integer class
+labels instead of dense one-hot arrays. OneHotView turns such an index
+array back into dense one-hot inputs lazily, for code that needs them.
+
+Every task also takes an rng for a single call of generate. batch_rng
+keys one on (seed, batch_index), so any batch can be regenerated on its
+own, in any order or process, and always comes out the same.
+"""
+
+import numpy as np
+
+
+def one_hot(indices, n_symbols, dtype="float32"):
+    """
+    Dense one-hot encoding of an array of symbol indices.
+
+    Parameters
+    ----------
+    indices   : integer array of any shape
+    n_symbols : number of symbols
+    dtype     : dtype of the result
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape indices.shape + (n_symbols,)
+    """
+    indices = np.asarray(indices)
+    out = np.zeros(indices.shape + (n_symbols,), dtype=dtype)
+    np.put_along_axis(out, indices[..., None].astype(np.intp), 1, axis=-1)
+    return out
+
+
+def batch_rng(seed, batch_index):
+    """
+    Randomizer for batch *batch_index* of the data set *seed*.
+
+    It is a RandomState over a counter-based Philox generator whose key is
+    the seed and whose counter starts at batch_index * 2 ** 192, so every
+    batch reads its own block of one random stream and no batch depends on
+    the ones generated before it.
+
+    Parameters
+    ----------
+    seed        : non-negative int, the data set seed
+    batch_index : non-negative int, below 2 ** 64
+
+    Returns
+    -------
+    numpy.random.RandomState
+    """
+    counter = np.array([0, 0, 0, batch_index], dtype=np.uint64)
+    return np.random.RandomState(np.random.Philox(key=seed, counter=counter))
+
+
+def generate_batch(task, seed, batch_index, batchsize, length, **kwargs):
+    """
+    Batch *batch_index* of *task*, as task.generate with batch_rng(seed,
+    batch_index). Extra keyword arguments (e.g. as_index) go to generate.
+    """
+    return task.generate(batchsize, length, rng=batch_rng(seed, batch_index), **kwargs)
+
+
+class OneHotView(object):
+    """
+    Read-only one-hot view of an array of symbol indices.
+
+    Indexing the view only encodes the selected elements, so a (length,
+    batch) uint8 array can stand in for the (length, batch, n_symbols)
+    float array without the whole dense tensor ever being built. An index
+    with one more component than the symbol array applies its last
+    component to the one-hot axis, e.g. view[:, 0, :] or view[t, :, 3].
+    np.asarray(view) encodes everything.
+    """
+
+    def __init__(self, indices, n_symbols, dtype="float32"):
+        self.indices = indices
+        self.n_symbols = n_symbols
+        self.dtype = np.dtype(dtype)
+
+    @property
+    def shape(self):
+        return self.indices.shape + (self.n_symbols,)
+
+    @property
+    def ndim(self):
+        return self.indices.ndim + 1
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        last = slice(None)
+        if len(key) > self.indices.ndim:
+            key, last = key[:-1], key[-1]
+        return one_hot(self.indices[key], self.n_symbols, self.dtype)[..., last]
+
+    def __array__(self, dtype=None, copy=None):
+        return one_hot(self.indices, self.n_symbols, dtype or self.dtype)
@@ -31,16 +31,34 @@ class TempOrderTask(object):
         self.nout = 4
         self.classifType = 'lastSoftmax'
 
-    def generate(self, batchsize: int, length: int):
+    def generate(self, batchsize: int, length: int, as_index: bool = False, rng=None):
+        """
+        generates a batch of sequences
+
+        :param batchsize: number of sequences
+        :type batchsize: int
+        :param length: sequence length
+        :type length: int
+        :param as_index: return uint8 symbols of shape (length, batchsize) and
+            uint8 class labels of shape (batchsize,) instead of one-hot arrays
+            (see task_utils.OneHotView for a dense view of them)
+        :type as_index: bool
+        :param rng: randomizer to use for this batch instead of self.rng,
+            e.g. task_utils.batch_rng(seed, batch_index)
+        :type rng: randomizer object
+        """
+        rng = self.rng if rng is None else rng
         l = length
-        p0 = self.rng.randint(int(l*0.1), size=(batchsize,)) + int(l*0.1)
-        v0 = self.rng.randint(2, size=(batchsize,))
-        p1 = self.rng.randint(int(l*0.1), size=(batchsize,)) + int(l*0.5)
-        v1 = self.rng.randint(2, size=(batchsize,))
+        p0 = rng.randint(int(l*0.1), size=(batchsize,)) + int(l*0.1)
+        v0 = rng.randint(2, size=(batchsize,))
+        p1 = rng.randint(int(l*0.1), size=(batchsize,)) + int(l*0.5)
+        v1 = rng.randint(2, size=(batchsize,))
         targ_vals = v0 + v1*2
-        vals = self.rng.randint(4, size=(l, batchsize)) + 2
+        vals = rng.randint(4, size=(l, batchsize)) + 2
         vals[p0, np.arange(batchsize)] = v0
         vals[p1, np.arange(batchsize)] = v1
+        if as_index:
+            return vals.astype(np.uint8), targ_vals.astype(np.uint8)
         #breakpoint()
         data = np.zeros((l, batchsize, 6), dtype=self.floatX)
         targ = np.zeros((batchsize, 4), dtype=self.floatX)
@@ -13,19 +13,23 @@ class TempOrder3bitTask(object):
         self.nout = 8
         self.classifType='lastSoftmax'
 
-     def generate(self, batchsize, length):
+     def generate(self, batchsize, length, as_index=False, rng=None):
+        # as_index returns uint8 symbols (length, batchsize) and class labels
+        rng = self.rng if rng is None else rng
         l = length
-        p0 = self.rng.randint(int(l*.1), size=(batchsize,)) + int(l*.1)
-        v0 = self.rng.randint(2, size=(batchsize,))
-        p1 = self.rng.randint(int(l*.1), size=(batchsize,)) + int(l*.3)
-        v1 = self.rng.randint(2, size=(batchsize,))
-        p2 = self.rng.randint(int(l*.1), size=(batchsize,)) + int(l*.6)
-        v2 = self.rng.randint(2, size=(batchsize,))
+        p0 = rng.randint(int(l*.1), size=(batchsize,)) + int(l*.1)
+        v0 = rng.randint(2, size=(batchsize,))
+        p1 = rng.randint(int(l*.1), size=(batchsize,)) + int(l*.3)
+        v1 = rng.randint(2, size=(batchsize,))
+        p2 = rng.randint(int(l*.1), size=(batchsize,)) + int(l*.6)
+        v2 = rng.randint(2, size=(batchsize,))
         targ_vals = v0 + v1*2 + v2 * 4
-        vals  = self.rng.randint(4, size=(l, batchsize))+2
+        vals  = rng.randint(4, size=(l, batchsize))+2
         vals[p0, numpy.arange(batchsize)] = v0
         vals[p1, numpy.arange(batchsize)] = v1
         vals[p2, numpy.arange(batchsize)] = v2
+        if as_index:
+            return vals.astype(numpy.uint8), targ_vals.astype(numpy.uint8)
         data = numpy.zeros((l, batchsize, 6), dtype=self.floatX)
         targ = numpy.zeros((batchsize, 8), dtype=self.floatX)
         data.reshape((l*batchsize, 6))[numpy.arange(l*batchsize),
@@ -11,14 +11,335 @@ import numpy as np
 
 import pandas as pd
 from tempOrder import TempOrderTask
+from mnist_data import (
+    load_csv_cached,
+    has_shards,
+    load_shard_index,
+    load_shards,
+    StreamingDataset,
+)
 from collections import OrderedDict
 import matplotlib.pyplot as plt
-from sklearn.preprocessing import OneHotEncoder
 
 np.set_printoptions(precision=10, threshold=sys.maxsize, suppress=True)
 
 
+class Workspace(object):
+    """
+    Named scratch buffers that are allocated once and reused between calls.
+
+    ``get`` returns a view of the requested shape over a flat buffer, which
+    is only reallocated when a larger size (or another dtype) than before is
+    asked for. Once a buffer has been sized for a full batch, the training
+    step writes into it with ``out=`` operations and allocates nothing
+    further.
+    """
+
+    def __init__(self, dtype=np.float32):
+        self.dtype = dtype
+        self.buffers = {}
+
+    def get(self, name, shape, dtype=None):
+        dtype = self.dtype if dtype is None else dtype
+        size = int(np.prod(shape))
+        buf = self.buffers.get(name)
+        if buf is None or buf.size < size or buf.dtype != dtype:
+            buf = np.empty(size, dtype)
+            self.buffers[name] = buf
+        return buf[:size].reshape(shape)
+
+
+class CheckpointedTrajectory(object):
+    """
+    Hidden-state trajectory that keeps only every k-th state (and the last
+    one) and recomputes the states in between on demand.
+
+    It is indexed like the (seq_length, batch, n_hid) array returned by
+    SRNN._hidden, including h[-1], and is meant for the reverse-time access
+    pattern of SRNN._calc_f_grads_fused: each segment of k states is rebuilt
+    from the checkpoint before it at most once per sweep. The input
+    projections of the loaded segment are available through ``xw``.
+    """
+
+    def __init__(self, model, x, h0, k):
+        self.model = model
+        self.x = x
+        self.h0 = h0
+        self.k = k
+        self.T = len(x)
+        self.ckpt = model.ws.get("ckpt", (self.T // k,) + h0.shape)
+        self.last = model.ws.get("h_last", h0.shape)
+        self.seg_h = model.ws.get("seg_h", (k,) + h0.shape)
+        self.seg_xw = model.ws.get("seg_xw", (k,) + h0.shape)
+        self.xw = _ProjectionView(self)
+        self.loaded = None
+        self._forward()
+
+    def __len__(self):
+        return self.T
+
+    def __getitem__(self, t):
+        t %= self.T
+        if not self._stored(t):
+            self._load(t // self.k)
+        return self._slot(t)
+
+    def projection(self, t):
+        t %= self.T
+        self._load(t // self.k)
+        return self.seg_xw[t % self.k]
+
+    def _stored(self, t):
+        return t == self.T - 1 or t % self.k == self.k - 1
+
+    def _slot(self, t):
+        if t == self.T - 1:
+            return self.last
+        if t % self.k == self.k - 1:
+            return self.ckpt[t // self.k]
+        return self.seg_h[t % self.k]
+
+    def _forward(self):
+        state = self.h0
+        for start in range(0, self.T, self.k):
+            end = min(start + self.k, self.T)
+            xw = self.model._project(self.x[start:end], out=self.seg_xw[: end - start])
+            for t in range(start, end):
+                state = self.model._f(None, state, xw[t - start], out=self._slot(t))
+        # the segment buffers are left holding the last segment
+        self.loaded = (self.T - 1) // self.k
+
+    def _load(self, s):
+        if s == self.loaded:
+            return
+        start = s * self.k
+        end = min(start + self.k, self.T)
+        xw = self.model._project(self.x[start:end], out=self.seg_xw[: end - start])
+        state = self.h0 if s == 0 else self._slot(start - 1)
+        # the last state of every segment is stored, so it is not recomputed
+        for t in range(start, end - 1):
+            state = self.model._f(None, state, xw[t - start], out=self._slot(t))
+        self.loaded = s
+
+
+class InverseTrajectory(object):
+    """
+    Hidden-state trajectory that keeps only the last state and rebuilds the
+    earlier ones backward with the learned inverse G during the sweep.
+
+    Like CheckpointedTrajectory it is indexed as the (seq_length, batch,
+    n_hid) array of SRNN._hidden, but it must be walked from the end, as
+    SRNN._calc_f_grads_fused does: h[t - 1] is taken as G(x[t], h[t]).
+    With k > 0 every k-th forward state is also stored, and the sweep
+    re-anchors on it to bound the drift of the reconstruction. The error
+    made at those anchors, and at the known initial state, is reported by
+    ``reconstruction_error``.
+    """
+
+    def __init__(self, model, x, h0, k=0):
+        self.model = model
+        self.x = x
+        self.h0 = h0
+        self.k = k
+        self.T = len(x)
+        self.anchors = model.ws.get("ckpt", (self.T // k if k else 0,) + h0.shape)
+        self.last = model.ws.get("h_last", h0.shape)
+        # h[t] lives in states[t % 2] while walking back
+        self.states = model.ws.get("inv_h", (2,) + h0.shape)
+        self.step_xw = model.ws.get("seg_xw", (1,) + h0.shape)
+        self.xw = _ProjectionView(self)
+        self.xw_t = None
+        self.t = self.T - 1
+        self.sq_error = 0.0
+        self.n_error = 0
+        self._forward()
+
+    def __len__(self):
+        return self.T
+
+    def __getitem__(self, t):
+        t %= self.T
+        if t == self.T - 1:
+            return self.last
+        if t == self.t - 1:
+            self._step_back()
+        # only the two most recent states are kept
+        if t not in (self.t, self.t + 1):
+            raise IndexError("InverseTrajectory must be walked back one step at a time.")
+        return self.states[t % 2]
+
+    def projection(self, t):
+        t %= self.T
+        if t != self.xw_t:
+            self.model._project(self.x[t : t + 1], out=self.step_xw)
+            self.xw_t = t
+        return self.step_xw[0]
+
+    def reconstruction_error(self):
+        """
+        Root mean squared error of the reconstructed states at the anchors
+        visited so far and, once the walk has reached h[0], at the initial
+        state h0.
+        """
+        if self.t == 0:
+            h0 = self.model._g(None, self[0], self.projection(0), out=self.states[1])
+            self._add_error(h0, self.h0)
+            self.t = -1
+        return np.sqrt(self.sq_error / max(self.n_error, 1))
+
+    def _anchored(self, t):
+        return self.k and t % self.k == self.k - 1
+
+    def _forward(self):
+        state = self.h0
+        for t in range(self.T):
+            if t == self.T - 1:
+                out = self.last
+            elif self._anchored(t):
+                out = self.anchors[t // self.k]
+            else:
+                out = self.states[t % 2]
+            state = self.model._f(None, state, self.projection(t), out=out)
+        self.states[(self.T - 1) % 2] = self.last
+
+    def _step_back(self):
+        t = self.t
+        prev = self.states[(t - 1) % 2]
+        self.model._g(None, self.states[t % 2], self.projection(t), out=prev)
+        if self._anchored(t - 1):
+            anchor = self.anchors[(t - 1) // self.k]
+            self._add_error(prev, anchor)
+            prev[...] = anchor
+        self.t = t - 1
+
+    def _add_error(self, h, h_true):
+        self.sq_error += float(np.sum(np.square(h - h_true)))
+        self.n_error += h.size
+
+
+class _ProjectionView(object):
+    # xw[t] view of a CheckpointedTrajectory or InverseTrajectory
+
+    def __init__(self, trajectory):
+        self.trajectory = trajectory
+
+    def __getitem__(self, t):
+        return self.trajectory.projection(t)
+
+
 class SRNN(object):
+    """
+    Simple RNN trained with target propagation through time.
+
+    Keyword options
+    ---------------
+    schedule : str
+        Order of the feedback (g) and forward (f) updates within an epoch.
+        "two_pass" (default) runs the g-step over every minibatch and then
+        the f-step over every minibatch, computing the hidden trajectory in
+        each pass. "fused" computes the trajectory once per minibatch and
+        uses it for the g-step followed immediately by the f-step, which
+        halves the forward-pass cost of an epoch. The targets of a fused
+        f-step see the Vhh/ch of its own minibatch rather than of the end
+        of the g-pass.
+    targets : str
+        How the f-step propagates targets. "stored" (default) materialises
+        the (T, batch, n_hid) target tensor and computes the forward
+        gradients with one GEMM per weight. "fused" produces the targets in
+        a reverse sweep that accumulates the gradients step by step and only
+        keeps two target states alive, trading T small GEMMs for
+        O(batch * n_hid) target memory. "inverse" runs the same sweep but
+        keeps only the last hidden state and rebuilds the earlier ones
+        backward with G, for O(batch * n_hid) activation memory at any
+        sequence length. Combined with checkpoint=k, every k-th state is
+        stored as an anchor that the reconstruction is reset to. The RMS
+        reconstruction error of the last f-step is kept in recon_error and
+        printed by fit. Needs the two_pass schedule.
+    horizon : int
+        0 (default) propagates targets through all seq_length steps. K > 0
+        only propagates targets to, and takes forward gradients from, the
+        last K steps of each sequence; the earlier steps are run forward
+        without storing their states. The f-step then costs O(K) in time
+        and memory beyond the forward pass. Must be smaller than seq_length
+        and cannot be combined with checkpoint, targets="inverse" or the
+        fused schedule, whose shared forward pass stores every state. Use
+        it with g_block to keep the g-phase from storing the trajectory.
+    g_block : int
+        0 (default) computes the g-step from the stored hidden trajectory.
+        k > 0 accumulates dVhh/dch online during the forward pass of the
+        g-step, k timesteps at a time, so the g-phase never stores the
+        (T, batch, n_hid) trajectory. Smaller k needs less memory, larger k
+        gives bigger GEMMs. Only used by the two_pass schedule, since the
+        fused schedule keeps the trajectory for its f-step anyway.
+    g_chunk : int
+        0 (default) computes the hidden states of the g-phase per minibatch.
+        n > 0 computes them for n training sequences at a time (rounded down
+        to whole minibatches, at least one) with large batched GEMMs, and
+        then runs the usual per-minibatch Vhh/ch updates from that cache.
+        Set it to the training set size to do the whole set in one block.
+        The cache takes 2 * T * n * n_hid * 4 bytes. Takes precedence over
+        g_block and only applies to the two_pass schedule.
+    checkpoint : int
+        0 (default) stores the whole hidden trajectory for the f-step.
+        k > 0 stores only every k-th hidden state (and the last one) and
+        recomputes each segment from its checkpoint during the reverse
+        target sweep, which then always runs fused. The f-step keeps about
+        (T / k + 2 * k) * batch * n_hid states instead of 2 * T * batch *
+        n_hid, at the cost of up to one extra forward pass; k near sqrt(T)
+        minimises memory. Measured trade-offs are listed in the README.
+        With targets="inverse" the stored states are used as anchors for
+        the backward reconstruction instead. Only applies to the two_pass
+        schedule.
+    lengths : numpy.ndarray or None
+        None (default) treats every sequence as seq_length steps long.
+        Otherwise the true length of every training sequence, with X
+        left-padded with zeros to X.shape[0] (see pad_sequences). fit then
+        sorts the sequences by length and packs them into buckets of at
+        most token_budget padded steps (see bucket_batches), so a batch is
+        only run for as long as its longest sequence. Padded steps are
+        masked: their states are held at zero and they take no part in the
+        targets or the gradients. Needs targets="stored" and cannot be
+        combined with checkpoint, horizon or g_block; g_chunk is ignored.
+    lengths_test : numpy.ndarray or None
+        The same for X_test, used by run_validation.
+    token_budget : int or None
+        Padded timesteps per bucket, batch_size * seq_length by default.
+    n_symbols : int or None
+        Size of the input vocabulary when X and X_test hold integer symbol
+        indices of shape (seq_length, n_samples) instead of one-hot vectors.
+        The input projection is then a gather of Wxh rows, and the Wxh
+        gradient is scatter-added into one row per symbol in the batch, so
+        the f-step only updates those rows. Defaults to the largest index in
+        X and X_test plus one.
+    index : numpy.ndarray or None
+        None (default) trains on every sequence of X, in order. Otherwise
+        the columns of X to train on, e.g. a random sample, in training
+        order. X is left as it is and every minibatch is gathered from it
+        into one contiguous block, so a sample never needs a copy of the
+        data. y is indexed the same way, and lengths (if given) still
+        refer to the columns of X.
+    index_test : numpy.ndarray or None
+        The same for X_test and y_test, used by run_validation.
+    input_scale : float
+        Factor the inputs are multiplied by before Wxh, e.g. 1 / 255 for
+        raw pixel values. It is applied to the small Wxh matrix and to its
+        gradient rather than to the data.
+    n_classes : int or None
+        Number of classes when y and y_test hold integer class labels of
+        shape (n_samples,) instead of one-hot rows. The cost is then a fused
+        log-softmax cross-entropy that reads the logit of the true class,
+        the output error subtracts 1 at the label, and accuracy compares
+        labels directly. Defaults to the largest label plus one. Needs
+        last_layer="softmax".
+
+    A StreamingDataset can be passed as X, with y=None, to train on a data
+    set that does not fit in memory: every pass over the training set then
+    reads it from disk in shuffled chunks. It cannot be combined with
+    lengths or index, and g_chunk is ignored. X_test may
+    be streamed as well (with y_test=None), and its integer labels are
+    then validated against the softmax whether y is one-hot or not. The
+    label form is decided per set, so y and y_test may also differ.
+    """
 
     def __init__(
         self,
@@ -35,11 +356,83 @@ class SRNN(object):
         g_learning_rate,
         f_learning_rate,
         i_learning_rate,
+        schedule="two_pass",
+        targets="stored",
+        g_block=0,
+        g_chunk=0,
+        checkpoint=0,
+        horizon=0,
+        lengths=None,
+        lengths_test=None,
+        token_budget=None,
+        n_symbols=None,
+        index=None,
+        index_test=None,
+        input_scale=1.0,
+        n_classes=None,
     ):
         super(SRNN, self).__init__()
 
-        self.n_inp = X.shape[2]  # [seq size n_inp]
-        self.n_out = y.shape[1]  # [size n_out]
+        if schedule not in ("two_pass", "fused"):
+            raise Exception("Unsupported schedule.")
+        self.schedule = schedule
+        if targets not in ("stored", "fused", "inverse"):
+            raise Exception("Unsupported target propagation.")
+        self.targets = targets
+        if (checkpoint or targets == "inverse") and schedule == "fused":
+            raise Exception("Checkpointing needs the two_pass schedule.")
+        self.recon_error = None
+        if horizon and (
+            horizon >= seq_length
+            or checkpoint
+            or targets == "inverse"
+            or schedule == "fused"
+        ):
+            raise Exception("Unsupported target horizon.")
+        if lengths is not None and (
+            targets != "stored" or checkpoint or horizon or g_block
+        ):
+            raise Exception("Variable-length sequences need the stored targets.")
+        self.horizon = horizon
+        self.checkpoint = checkpoint
+        self.g_block = g_block
+        self.g_chunk = g_chunk
+        self.grad_Wxh_rows = None
+
+        # X is either (seq size n_inp) or (seq size) integer symbol indices
+        self.sparse_input = X.ndim == 2
+        if self.sparse_input:
+            if n_symbols is None:
+                n_symbols = int(max(X.max(), X_test.max())) + 1
+            self.n_inp = n_symbols
+        else:
+            self.n_inp = X.shape[2]
+        # a streamed training set brings its own labels, see StreamingDataset
+        self.streaming = isinstance(X, StreamingDataset)
+        if self.streaming and (lengths is not None or index is not None):
+            raise Exception("Unsupported options for a streamed data set.")
+        # y is either one-hot (size n_out) or integer class labels (size),
+        # decided per set: a streamed X_test yields integer labels whatever
+        # y is, and an in-memory X_test goes by y_test
+        self.int_labels = self.streaming or y.ndim == 1
+        streaming_test = isinstance(X_test, StreamingDataset)
+        int_labels_test = streaming_test or y_test.ndim == 1
+        if (self.int_labels or int_labels_test) and last_layer != "softmax":
+            raise Exception("Integer labels need a softmax output.")
+        if self.streaming:
+            self.n_out = X.n_classes
+        elif self.int_labels:
+            if n_classes is None:
+                if streaming_test:
+                    n_test = X_test.n_classes
+                elif int_labels_test:
+                    n_test = int(y_test.max()) + 1
+                else:
+                    n_test = y_test.shape[1]
+                n_classes = max(int(y.max()) + 1, n_test)
+            self.n_out = n_classes
+        else:
+            self.n_out = y.shape[1]
 
         self.X = X
         self.y = y
@@ -52,6 +445,8 @@ class SRNN(object):
         self.last_layer = last_layer
         self.batch_size = batch_size
         self.rng = rng
+        # float32 stream for the noise injected into the feedback targets
+        self.noise_rng = np.random.default_rng(rng.randint(2 ** 31 - 1))
         self.g_lr = g_learning_rate
         self.f_lr = f_learning_rate
         self.i_lr = i_learning_rate
@@ -60,6 +455,21 @@ class SRNN(object):
 
         self.h0 = np.zeros((self.batch_size, self.n_hid), np.float32)
 
+        self.lengths = lengths
+        self.lengths_test = lengths_test
+        if token_budget is None:
+            token_budget = batch_size * seq_length
+        self.index = index
+        self.index_test = index_test
+        self.input_scale = input_scale
+        # number of training sequences
+        self.n_train = X.shape[1] if index is None else len(index)
+        self.buckets = None
+        if lengths is not None and index is None:
+            self.buckets = bucket_batches(lengths, token_budget)
+        elif lengths is not None:
+            self.buckets = [index[b] for b in bucket_batches(lengths[index], token_budget)]
+
         self.Wxh = self.rand_ortho(
             (self.n_hid, self.n_inp), np.sqrt(6.0 / (self.n_inp + self.n_hid))
         ).T
@@ -87,6 +497,69 @@ class SRNN(object):
         self.params["Vhh"] = self.Vhh
         self.params["ch"] = self.ch
 
+        self.ws = Workspace()
+        self._reserve_workspace()
+
+    def _reserve_workspace(self):
+        # Scratch buffers for the training step, sized once for a full batch
+        seq_shape = (self.seq_length, self.batch_size, self.n_hid)
+        if self.horizon:
+            seq_shape = (self.horizon + 1, self.batch_size, self.n_hid)
+        step_shape = (self.batch_size, self.n_hid)
+        # states reconstructed per call of the feedback kernel
+        g_shape = (self.g_block or self.seq_length - 1, self.batch_size, self.n_hid)
+        shapes = OrderedDict(
+            [
+                ("g", step_shape),
+                ("delta", step_shape),
+                ("hn", g_shape),
+                ("hp", g_shape),
+                ("hc", g_shape),
+                ("dtanh", g_shape),
+                ("dWhh", (self.n_hid, self.n_hid)),
+                ("dWhh_t", (self.n_hid, self.n_hid)),
+                ("dVhh", (self.n_hid, self.n_hid)),
+                ("dVhh_t", (self.n_hid, self.n_hid)),
+                ("dWxh", (self.n_inp, self.n_hid)),
+                ("dWxh_t", (self.n_inp, self.n_hid)),
+                ("dbh", (self.n_hid,)),
+                ("dbh_t", (self.n_hid,)),
+                ("dch", (self.n_hid,)),
+                ("dch_t", (self.n_hid,)),
+                ("update", (max(self.n_hid, self.n_inp), max(self.n_hid, self.n_out))),
+            ]
+        )
+        if not ((self.checkpoint or self.targets == "inverse") and self.g_block):
+            # the checkpointed f-step and the online g-step never hold these
+            shapes["xw"] = seq_shape
+            shapes["h"] = seq_shape
+        if self.targets == "inverse":
+            n_anchors = self.seq_length // self.checkpoint if self.checkpoint else 0
+            shapes["h_"] = (2,) + step_shape
+            shapes["ckpt"] = (n_anchors,) + step_shape
+            shapes["h_last"] = step_shape
+            shapes["inv_h"] = (2,) + step_shape
+            shapes["seg_xw"] = (1,) + step_shape
+        elif self.checkpoint:
+            shapes["h_"] = (2,) + step_shape
+            shapes["ckpt"] = (self.seq_length // self.checkpoint,) + step_shape
+            shapes["h_last"] = step_shape
+            shapes["seg_h"] = (self.checkpoint,) + step_shape
+            shapes["seg_xw"] = (self.checkpoint,) + step_shape
+        elif self.targets == "stored":
+            shapes["h_"] = seq_shape
+            shapes["delta_seq"] = seq_shape
+            shapes["dtanh"] = seq_shape
+        else:
+            shapes["h_"] = (2,) + step_shape
+        if self.horizon:
+            shapes["h_prefix"] = (2,) + step_shape
+        if self.g_block:
+            shapes["h_block"] = (self.g_block + 1,) + step_shape
+            shapes["xw_block"] = g_shape
+        for name, shape in shapes.items():
+            self.ws.get(name, shape)
+
     def sftmx(self, x, axis=1):
         # Subtract the maximum value for numerical stability]
         exp_x = np.exp(x - np.max(x, axis=axis, keepdims=True))
@@ -117,19 +590,152 @@ class SRNN(object):
     def _sample(self, x):
         return x
 
-    def _f(self, x, hs):
-        z = self.activ(hs @ self.Whh + x @ self.Wxh + self.bh)
-        return z
+    def _project(self, x, out=None):
+        """
+        Projects a whole input block through Wxh at once.
+
+        Parameters
+        ----------
+        x : numpy.ndarray
+            Inputs of shape (seq_length, batch, n_inp), or symbol indices of
+            shape (seq_length, batch). A single step of shape (batch, n_inp),
+            or (batch,) symbols, is projected the same way.
+
+        Returns
+        -------
+        numpy.ndarray
+            x @ Wxh of shape (seq_length, batch, n_hid), computed as a single
+            GEMM over all timesteps instead of one small GEMM per step. With a
+            single input channel (pixel MNIST) this is a broadcast product,
+            and for symbol indices it is a gather of the Wxh rows.
+        """
+        Wxh = self._input_weights()
+        if self.sparse_input:
+            return np.take(Wxh, x, axis=0, out=out)
+        if self.n_inp == 1:
+            return np.multiply(x, Wxh[0], out=out)
+        shape = x.shape[:-1] + (self.n_hid,)
+        if out is None:
+            out = np.empty(shape, np.float32)
+        if out.flags.c_contiguous:
+            np.matmul(x.reshape(-1, self.n_inp), Wxh, out=out.reshape(-1, self.n_hid))
+        else:
+            np.matmul(x, Wxh, out=out)
+        return out
+
+    def _input_weights(self):
+        # Wxh with input_scale folded in, so the inputs are never rescaled
+        if self.input_scale == 1.0:
+            return self.Wxh
+        Wxh = self.ws.get("Wxh_scaled", self.Wxh.shape)
+        return np.multiply(self.Wxh, self.input_scale, out=Wxh)
+
+    def _wxh_grad_rows(self, x):
+        """
+        Prepares the Wxh gradient of a batch of inputs *x*.
 
-    def _g(self, x, hs):
-        return self.activ(hs @ self.Vhh + x @ self.Wxh + self.ch)
+        Returns
+        -------
+        tuple
+            The rows of Wxh that get a gradient and the inputs to pass to
+            _input_grad. For dense inputs these are None and *x* itself, and
+            the gradient is the full (n_inp, n_hid) matrix. For symbol
+            indices they are the distinct symbols in *x* and the position of
+            every symbol among them, so the gradient only has one row per
+            symbol seen. The rows are kept in grad_Wxh_rows for _step_f.
+        """
+        if not self.sparse_input:
+            self.grad_Wxh_rows = None
+            return None, x
+        rows, pos = np.unique(np.asarray(x), return_inverse=True)
+        self.grad_Wxh_rows = rows
+        return rows, pos.reshape(x.shape)
+
+    def _input_grad(self, x, delta, out):
+        """
+        Writes x.T @ delta, the Wxh gradient of the inputs *x*, into *out*.
 
-    def _hidden(self, x):
-        h = np.empty((self.seq_length, self.batch_size, self.n_hid), np.float32)
-        h[0, :, :] = self._f(x[0, :, :], self.h0)
+        For symbol indices (as positions from _wxh_grad_rows) this is a
+        scatter-add of the delta rows into the rows of the symbols that were
+        seen, instead of a GEMM with a one-hot matrix that is mostly zeros.
+        """
+        if not self.sparse_input:
+            np.matmul(x.reshape(-1, self.n_inp).T, delta, out=out)
+        else:
+            out[...] = 0
+            np.add.at(out, x.reshape(-1), delta)
+        if self.input_scale != 1.0:
+            out *= self.input_scale
+        return out
 
-        for t in range(1, self.seq_length):
-            h[t, :, :] = self._f(x[t, :, :], h[t - 1].copy())
+    def _input_buffer(self, name, steps):
+        # workspace buffer for an input block of *steps* = (T, batch) or (batch,)
+        if self.sparse_input:
+            return self.ws.get(name, steps, self.X.dtype)
+        return self.ws.get(name, steps + (self.n_inp,))
+
+    def _train_inputs(self, start, end, name="x_batch"):
+        # training sequences start:end, a view of X or a block gathered by index
+        if self.index is None:
+            return self.X[:, start:end]
+        return self._take(self.X, self.index[start:end], name)
+
+    def _train_targets(self, start, end):
+        if self.index is None:
+            return self.y[start:end]
+        return self.y[self.index[start:end]]
+
+    def _take(self, X, idx, name):
+        # columns idx of X, gathered into one contiguous workspace block
+        x = self.ws.get(name, (len(X), len(idx)) + X.shape[2:], X.dtype)
+        return np.take(X, idx, axis=1, out=x)
+
+    def _batch_projection(self, x):
+        # projection of a training batch, written into the workspace
+        return self._project(x, out=self.ws.get("xw", x.shape[:2] + (self.n_hid,)))
+
+    def _f(self, x, hs, xw=None, out=None):
+        # xw is the precomputed x @ Wxh for this step, see _project
+        if xw is None:
+            xw = self._project(x)
+        z = np.matmul(hs, self.Whh, out=out)
+        z += xw
+        z += self.bh
+        return self.activ(z, out=z)
+
+    def _g(self, x, hs, xw=None, out=None):
+        if xw is None:
+            xw = self._project(x)
+        z = np.matmul(hs, self.Vhh, out=out)
+        z += xw
+        z += self.ch
+        return self.activ(z, out=z)
+
+    def _hidden(self, x, xw=None, mask=None):
+        if xw is None:
+            xw = self._batch_projection(x)
+        h = self.ws.get("h", x.shape[:2] + (self.n_hid,))
+        return self._trajectory(xw, self._initial_state(x.shape[1]), h, mask)
+
+    def _initial_state(self, batch):
+        # zero state for a batch, bucketed batches need not be batch_size wide
+        if batch == self.batch_size:
+            return self.h0
+        h0 = self.ws.get("h0", (batch, self.n_hid))
+        h0[...] = 0
+        return h0
+
+    def _trajectory(self, xw, h0, h, mask=None):
+        # runs the recurrence from h0 over the projected inputs xw into h,
+        # holding the left-padded steps of every sequence at zero if masked
+        self._f(None, h0, xw[0], out=h[0])
+        if mask is not None:
+            h[0] *= mask[0]
+
+        for t in range(1, len(xw)):
+            self._f(None, h[t - 1], xw[t], out=h[t])
+            if mask is not None:
+                h[t] *= mask[t]
         return h
 
     @staticmethod
@@ -143,114 +749,268 @@ class SRNN(object):
     def _gaussian(x, noise):
         return np.random.randn(*x.shape) * noise
 
-    def _get_targets(self, x, hs_tmax, h, cost, ilr, error):
-        h_ = np.zeros((self.seq_length, self.batch_size, self.n_hid), np.float32)
-        z = np.dot(error, (self.Why).T) / h.shape[1]
-        h_[-1, :, :] = hs_tmax - ilr * z  # torch.from_numpy(z)
-        h_[-1, :, :] = h[-1, :, :] - hs_tmax + h_[-1, :, :]
-
-        for t in range(self.seq_length - 2, -1, -1):
-            h_[t] = (
-                h[t]
-                - self._g(x[t + 1, :, :], h[t + 1])
-                + self._g(x[t + 1, :, :], h_[t + 1])
-            )
+    def _tanh_error(self, hp, hp_cap, out):
+        """
+        Writes 2 * (hp - hp_cap) * (1 - tanh(hp) ** 2) into *out*.
+        """
+        d = self.ws.get("dtanh", hp.shape)
+        np.tanh(hp, out=d)
+        np.square(d, out=d)
+        np.subtract(1, d, out=d)
+        np.subtract(hp, hp_cap, out=out)
+        out *= d
+        out *= 2
+        return out
 
+    def _get_targets(self, x, hs_tmax, h, cost, ilr, error, xw=None, mask=None):
+        if xw is None:
+            xw = self._batch_projection(x)
+        h_ = self.ws.get("h_", h.shape)
+        g = self.ws.get("g", h.shape[1:])
+        self._last_target(hs_tmax, h[-1], ilr, error, out=h_[-1])
+
+        # The correction h[t] - G(x[t+1], h[t+1]) only depends on the forward
+        # trajectory, so it is computed for all steps with one stacked GEMM.
+        # Only G(x[t+1], h_[t+1]) is left for the sequential sweep.
+        rows = (-1, self.n_hid)
+        self._g(None, h[1:].reshape(rows), xw[1:].reshape(rows), out=h_[:-1].reshape(rows))
+        np.subtract(h[:-1], h_[:-1], out=h_[:-1])
+
+        for t in range(len(h) - 2, -1, -1):
+            h_[t] += self._g(x[t + 1], h_[t + 1], xw[t + 1], out=g)
+
+        if mask is not None:
+            # padded targets equal their zero states, so the padded steps
+            # get no error in _calc_f_grads
+            h_ *= mask
         return h_
 
-    def _calc_g_grads(self, x, h):
-        grad_dVhh = np.zeros((self.seq_length, self.n_hid, self.n_hid), np.float32)
-        grad_dch = np.zeros((self.seq_length, self.n_hid), np.float32)
-
-        def targets_grads(h, x):
-            per = h.shape[1]
-            noise_shape = np.shape(h)
-            noise = np.random.normal(0, 0.001, noise_shape)
-            hp_with_noise_in_h = self._f(x, h + noise)
-            h_cap_with_noise = self._g(x, hp_with_noise_in_h)
-            h_cap_error = h_cap_with_noise - (h + noise)  # predictions - truth
-
-            def tanh_derivative(x):
-                return 1 - np.tanh(x) ** 2
-
-            grad_G = (
-                np.dot(
-                    (2 * h_cap_error * tanh_derivative(h_cap_with_noise)).T,
-                    hp_with_noise_in_h,
-                ).T
-                / per
-            )
-            grad_g = (
-                np.sum(
-                    2 * h_cap_error * tanh_derivative(h_cap_with_noise),
-                    axis=0,
-                    keepdims=True,
-                )
-                / per
-            )
-            return grad_G, grad_g
-
-        for t in range(1, len(h)):
-            grad_dVhh[t], grad_dch[t] = targets_grads(h[t], x[t, :, :])
-
-        return np.sum(grad_dVhh, 0), np.sum(grad_dch, 0)
-
-    def _calc_f_grads(self, x, h, h_, cost, out, target):
-        # h_ -> target
-
-        def forward_grads_final(hp, hp_cap, h):
-            # hp_cap -> label
-            # hp -> pred output
-
-            pers = h.shape[1]
-            hp_error = hp - hp_cap  # predictions - truth
-            # self.Why.shape = (100,4)
-            # h -> (100, 20), 20 is batch_size
-            grad_F = np.dot(h, hp_error) / pers
-            grad_f = np.sum(hp_error, axis=0, keepdims=True) / pers
-            return grad_F, grad_f
-
-        out_np = out  # .detach().numpy()
-        target_np = target  # .detach().numpy()
-        h_last_np = h[-1].T
-
-        grad_dwhy, grad_dby = forward_grads_final(out_np, target_np, h_last_np)
-        grad_dWhh = np.zeros((self.seq_length, self.n_hid, self.n_hid), np.float32)
-        grad_dWxh = np.zeros((self.seq_length, self.n_inp, self.n_hid), np.float32)
-        grad_dbh = np.zeros((self.seq_length, self.n_hid), np.float32)
-
-        def forward_grads(hp, hp_cap, h):
-            def tanh_derivative(x):
-                return 1 - np.tanh(x) ** 2
-
-            pers = h.shape[1]
-            hp_error = hp - hp_cap
-            grad_F = np.dot((2 * hp_error * tanh_derivative(hp)).T, h).T / pers
-            grad_f = (
-                np.sum(2 * hp_error * tanh_derivative(hp), axis=0, keepdims=True) / pers
-            )
+    def _last_target(self, hs_tmax, h_last, ilr, error, out):
+        z = np.dot(error, (self.Why).T) / error.shape[0]
+        out[...] = hs_tmax - ilr * z  # torch.from_numpy(z)
+        out[...] = h_last - hs_tmax + out
+        return out
 
-            return grad_F, grad_f
+    def _calc_g_grads(self, x, h, xw=None, noise=0.0, mask=None):
+        if xw is None:
+            xw = self._batch_projection(x)
+        dVhh = self.ws.get("dVhh", (self.n_hid, self.n_hid))
+        dch = self.ws.get("dch", (self.n_hid,))
+        dVhh[...] = 0
+        dch[...] = 0
+        self._add_g_grads(
+            h[1:], xw[1:], noise, dVhh, dch, None if mask is None else mask[1:]
+        )
+        dVhh /= self.n_hid
+        dch /= self.n_hid
+        return dVhh, dch
+
+    def _add_g_grads(self, hs, xws, noise, dVhh, dch, mask=None):
+        # Every step is reconstructed independently from its state hs[i], so
+        # the noise is drawn once and F and G run as stacked GEMMs over all
+        # steps * batch rows. Extra target corruption (the model's *noise*) is
+        # folded into the same draw, as the sum of the two Gaussians.
+        shape = hs.shape
+        if not xws.flags.c_contiguous:
+            # minibatch slice of a larger cached block, see _g_phase_chunked
+            xw_rows = self.ws.get("xw_rows", shape)
+            xw_rows[...] = xws
+            xws = xw_rows
+        hn = self.ws.get("hn", shape)
+        hp = self.ws.get("hp", shape)
+        hc = self.ws.get("hc", shape)
+        self.noise_rng.standard_normal(shape, dtype=np.float32, out=hn)
+        hn *= np.sqrt(0.001 ** 2 + noise ** 2)
+        hn += hs
+
+        rows = (-1, self.n_hid)
+        self._f(None, hn.reshape(rows), xws.reshape(rows), out=hp.reshape(rows))
+        self._g(None, hp.reshape(rows), xws.reshape(rows), out=hc.reshape(rows))
+        # predictions - truth, written over the noisy targets
+        delta = self._tanh_error(hc, hn, out=hn)
+        if mask is not None:
+            # padded steps are not reconstructed
+            delta *= mask
+        delta = delta.reshape(rows)
+
+        dVhh += np.matmul(hp.reshape(rows).T, delta, out=self.ws.get("dVhh_t", dVhh.shape))
+        dch += np.sum(delta, axis=0, out=self.ws.get("dch_t", dch.shape))
+
+    def _calc_g_grads_online(self, x):
+        """
+        Runs the forward pass of the g-step and accumulates dVhh/dch while
+        the hidden states are produced, without storing the trajectory.
 
-        for t in range(0, len(h)):
-            # h -> output
-            # h_ -> pred
-            grad_dWhh[t], grad_dbh[t] = forward_grads(h[t], h_[t], h[t - 1])
-            grad_dbh[t] = grad_dbh[t].flatten()
-            grad_dWxh[t], _ = forward_grads(h[t], h_[t], x[t - 1])
+        The recurrence is advanced g_block steps at a time; each block of
+        fresh states (and its input projection) is handed to the batched
+        reconstruction kernel and then dropped, so memory is
+        O(g_block * batch * n_hid) regardless of the sequence length.
+        """
+        k = self.g_block
+        step = (x.shape[1], self.n_hid)
+        # slot 0 holds the state carried in from the previous block
+        hb = self.ws.get("h_block", (k + 1,) + step)
+        xwb = self.ws.get("xw_block", (k,) + step)
+        dVhh = self.ws.get("dVhh", (self.n_hid, self.n_hid))
+        dch = self.ws.get("dch", (self.n_hid,))
+        dVhh[...] = 0
+        dch[...] = 0
+
+        hb[0] = 0
+        for t0 in range(0, len(x), k):
+            n = min(k, len(x) - t0)
+            self._project(x[t0 : t0 + n], out=xwb[:n])
+            for i in range(n):
+                self._f(None, hb[i], xwb[i], out=hb[i + 1])
+            # the first state of the sequence is not reconstructed
+            skip = 1 if t0 == 0 else 0
+            if n > skip:
+                self._add_g_grads(hb[1 + skip : n + 1], xwb[skip:n], self.noise, dVhh, dch)
+            hb[0] = hb[n]
+
+        dVhh /= self.n_hid
+        dch /= self.n_hid
+        return dVhh, dch
+
+    def _calc_out_grads(self, out, target, hs_tmax):
+        # target -> label
+        # out -> pred output
+        pers = hs_tmax.shape[0]
+        hp_error = self._output_error(out, target)  # predictions - truth
+        # self.Why.shape = (100,4)
+        # hs_tmax -> (20, 100), 20 is batch_size
+        grad_F = np.dot(hs_tmax.T, hp_error) / pers
+        grad_f = np.sum(hp_error, axis=0) / pers
+        return grad_F, grad_f
+
+    def _calc_f_grads(self, x, h, h_, cost, out, target, first=0):
+        # h_ -> target, first = 1 leaves h[0] out (it only feeds h[1])
+        grad_dwhy, grad_dby = self._calc_out_grads(out, target, h[-1])
+
+        dWhh = self.ws.get("dWhh", (self.n_hid, self.n_hid))
+        wxh_rows, x_grad = self._wxh_grad_rows(x)
+        n_rows = self.n_inp if wxh_rows is None else len(wxh_rows)
+        dWxh = self.ws.get("dWxh", (n_rows, self.n_hid))
+        dbh = self.ws.get("dbh", (self.n_hid,))
+        dWhh_t = self.ws.get("dWhh_t", dWhh.shape)
+        dWxh_t = self.ws.get("dWxh_t", dWxh.shape)
+
+        # h -> output, h_ -> pred. All timesteps share the same form, so the
+        # errors are computed for the whole sequence at once and contracted
+        # over the flattened (T * B) rows with a single GEMM per weight.
+        delta = self._tanh_error(h, h_, out=self.ws.get("delta_seq", h.shape))
+        rows = delta[1:].reshape(-1, self.n_hid)
+        np.matmul(h[:-1].reshape(-1, self.n_hid).T, rows, out=dWhh)
+        self._input_grad(x_grad[:-1], rows, out=dWxh)
+        if first == 0:
+            # t = 0 pairs with h[-1] and x[-1], as in the original per-step loop
+            dWhh += np.matmul(h[-1].T, delta[0], out=dWhh_t)
+            dWxh += self._input_grad(x_grad[-1], delta[0], out=dWxh_t)
+        np.sum(delta[first:].reshape(-1, self.n_hid), axis=0, out=dbh)
+
+        # the per-step gradients are normalised by the width of their inputs
+        dWhh /= self.n_hid
+        dWxh /= self.n_inp
+        dbh /= self.n_hid
 
         # returns dWhh, dWxh, dbh, dwhy, dby
         return (
-            np.sum(grad_dWhh, axis=0),
-            np.sum(grad_dWxh, axis=0),
-            np.sum(grad_dbh, axis=0),
+            dWhh,
+            dWxh,
+            dbh,
             grad_dwhy,
-            grad_dby.flatten(),
+            grad_dby,
         )
 
-    def forward(self, x, y):
-        h = self._hidden(x)
-        hs_tmax = h[-1].copy()
+    def _calc_f_grads_fused(self, x, h, hs_tmax, ilr, error, out, target, xw, first=0):
+        """
+        Computes the forward gradients in one reverse-time sweep that
+        produces each target h_[t] and immediately adds its contribution to
+        dWhh, dWxh and dbh. Only h_[t] and h_[t - 1] are live at any time, so
+        target memory is O(batch * n_hid) instead of O(T * batch * n_hid).
+        The gradients are the same as _get_targets followed by _calc_f_grads,
+        and the sweep stops at h[first].
+        """
+        grad_dwhy, grad_dby = self._calc_out_grads(out, target, hs_tmax)
+
+        dWhh = self.ws.get("dWhh", (self.n_hid, self.n_hid))
+        wxh_rows, x_grad = self._wxh_grad_rows(x)
+        n_rows = self.n_inp if wxh_rows is None else len(wxh_rows)
+        dWxh = self.ws.get("dWxh", (n_rows, self.n_hid))
+        dbh = self.ws.get("dbh", (self.n_hid,))
+        dWhh_t = self.ws.get("dWhh_t", dWhh.shape)
+        dWxh_t = self.ws.get("dWxh_t", dWxh.shape)
+        dbh_t = self.ws.get("dbh_t", dbh.shape)
+        dWhh[...] = 0
+        dWxh[...] = 0
+        dbh[...] = 0
+
+        step = hs_tmax.shape
+        h_ = self.ws.get("h_", (2,) + step)  # h_[t] lives in h_[t % 2]
+        g = self.ws.get("g", step)
+        delta = self.ws.get("delta", step)
+
+        T = len(h)
+        self._last_target(hs_tmax, h[T - 1], ilr, error, out=h_[(T - 1) % 2])
+        for t in range(T - 1, first - 1, -1):
+            self._tanh_error(h[t], h_[t % 2], out=delta)
+            # t = 0 pairs with h[-1] and x[-1], as in _calc_f_grads
+            dWhh += np.matmul(h[t - 1].T, delta, out=dWhh_t)
+            dWxh += self._input_grad(x_grad[t - 1], delta, out=dWxh_t)
+            dbh += np.sum(delta, axis=0, out=dbh_t)
+            if t == first:
+                break
+            # h_[t-1] = h[t-1] - G(x[t], h[t]) + G(x[t], h_[t])
+            self._g(x[t], h[t], xw[t], out=g)
+            np.subtract(h[t - 1], g, out=h_[(t - 1) % 2])
+            h_[(t - 1) % 2] += self._g(x[t], h_[t % 2], xw[t], out=g)
+
+        dWhh /= self.n_hid
+        dWxh /= self.n_inp
+        dbh /= self.n_hid
+        return dWhh, dWxh, dbh, grad_dwhy, grad_dby
+
+    def forward(self, x, y, xw=None, mask=None):
+        h = self._hidden(x, xw, mask)
+        hs_tmax = h[-1]
+        return hs_tmax, h, self._output(hs_tmax)
+
+    def _output_cost(self, hs_tmax, y):
+        # the output of the last states and its cost against y
+        if self.int_labels:
+            return self._softmax_cross_entropy(hs_tmax @ self.Why + self.by, y)
+        out = self._output(hs_tmax)
+        if self.last_layer == "softmax":
+            cost = self._cross_entropy(out, y)
+        elif self.last_layer == "linear":
+            cost = self._mse(out, y).sum()
+        else:
+            raise Exception("Unsupported classification type.")
+        return out, cost
+
+    @staticmethod
+    def _softmax_cross_entropy(z, labels):
+        """
+        Softmax of the logits *z* and its mean cross-entropy against integer
+        *labels*, from one log-softmax: the cost only reads the shifted logit
+        of the true class and the log-sum-exp of each row.
+        """
+        z = z - np.max(z, axis=1, keepdims=True)
+        exp_z = np.exp(z)
+        total = np.sum(exp_z, axis=1)
+        cost = np.mean(np.log(total) - z[np.arange(len(z)), labels])
+        exp_z /= total[:, None]
+        return exp_z, cost
+
+    def _output_error(self, out, y):
+        # predictions - truth, for one-hot rows or integer labels
+        if not self.int_labels:
+            return out - y
+        error = out.copy()
+        error[np.arange(len(error)), y] -= 1
+        return error
+
+    def _output(self, hs_tmax):
         out = hs_tmax @ self.Why + self.by
         if self.last_layer == "softmax":
             out = self.sftmx(out)
@@ -259,18 +1019,27 @@ class SRNN(object):
         else:
             raise Exception("Unsupported classification type.")
 
-        return hs_tmax, h, out
-
-    def _validate(self, x):
-        n_val_samples = x.shape[1]
-        h0 = np.zeros((n_val_samples, self.n_hid), np.float32)
-        h = np.empty((self.seq_length, n_val_samples, self.n_hid), np.float32)
-        h[0, :, :] = self._f(x[0, :, :], h0)
-        for t in range(1, self.seq_length):
-            h[t, :, :] = self._f(x[t, :, :], h[t - 1].copy())
-
-        out = h[-1] @ self.Why + self.by
+        return out
 
+    def _validate(self, x, mask=None, index=None, logits=False):
+        # index selects the columns of x to validate on, see index_test
+        n_val_samples = x.shape[1] if index is None else len(index)
+        shape = (len(x), n_val_samples, self.n_hid)
+        if index is not None:
+            x = self._take(x, index, "val_x")
+        xw = self._project(x, out=self.ws.get("val_xw", shape))
+        # only the last state is needed, so two buffers are swapped over time
+        h = self.ws.get("val_h", (2, n_val_samples, self.n_hid))
+        h[1] = 0
+        for t in range(len(x)):
+            self._f(x[t], h[(t - 1) % 2], xw[t], out=h[t % 2])
+            if mask is not None:
+                h[t % 2] *= mask[t]
+
+        out = h[(len(x) - 1) % 2] @ self.Why + self.by
+
+        if logits:
+            return out
         if self.last_layer == "softmax":
             out = self.sftmx(out)
         elif self.last_layer != "linear":
@@ -283,9 +1052,30 @@ class SRNN(object):
         valid_cost = 0
         valid_err = 0
 
-        out = self._validate(x)
-
-        if self.last_layer == "softmax":
+        index = self.index_test if x is self.X_test else None
+        # the label form of this set, see __init__
+        int_labels = isinstance(x, StreamingDataset) or y.ndim == 1
+        if isinstance(x, StreamingDataset):
+            # only the outputs and labels of the whole set are kept
+            x_chunk = max(self.batch_size, x.chunk_records)
+            batches = [
+                (self._validate(xb, logits=True), yb)
+                for xb, yb in x.batches(x_chunk, False, True)
+            ]
+            out = np.concatenate([b[0] for b in batches])
+            y = np.concatenate([b[1] for b in batches])
+        elif x is self.X_test and self.lengths_test is not None:
+            out = self._validate_bucketed(x, self.lengths_test, index, int_labels)
+        else:
+            out = self._validate(x, index=index, logits=int_labels)
+        if index is not None:
+            y = y[index]
+
+        if int_labels:
+            # out holds the logits here, whose argmax is that of the softmax
+            _, valid_cost = self._softmax_cross_entropy(out, y)
+            valid_err = np.mean(np.argmax(out, axis=1) != y)
+        elif self.last_layer == "softmax":
             valid_cost = self._cross_entropy(out, y)
             y = np.argmax(y, axis=1)
             y_hat = np.argmax(out, axis=1)
@@ -311,35 +1101,144 @@ class SRNN(object):
 
         return valid_cost, valid_err
 
-    def _step_g(self, x, y):
-        h = self._hidden(x)
-
-        # Corrupt targets with noise
-        if self.noise != 0:
-            h = self._hidden(x)
-            h = h + self._gaussian(h)
+    def _step_g(self, x, y, mask=None):
+        if self.g_block:
+            Vhh_grad, ch_grad = self._calc_g_grads_online(x)
+            self._update(self.Vhh, Vhh_grad, self.g_lr)
+            self._update(self.ch, ch_grad, self.g_lr)
+            return
 
-        Vhh_grad, ch_grad = self._calc_g_grads(x, h)
-        self.Vhh = self.Vhh - Vhh_grad * self.g_lr
-        self.ch = self.ch - ch_grad * self.g_lr
+        xw = self._batch_projection(x)
+        h = self._hidden(x, xw, mask)
+        self._update_g(x, h, xw, mask)
 
-    def _step_f(self, ilr, x, y):
+    def _update_g(self, x, h, xw, mask=None):
+        # targets are corrupted with noise inside _calc_g_grads
+        Vhh_grad, ch_grad = self._calc_g_grads(x, h, xw, self.noise, mask)
+        self._update(self.Vhh, Vhh_grad, self.g_lr)
+        self._update(self.ch, ch_grad, self.g_lr)
 
-        out = np.zeros((self.batch_size, self.n_out), np.float32)
-        hs_tmax, h, out_ = self.forward(x, y)
-        out = out + out_
+    def _g_phase_chunked(self, n_batches):
+        """
+        Runs the g-phase of an epoch with the hidden trajectories of g_chunk
+        training sequences computed together.
+
+        Whh, Wxh and bh do not change during the g-phase, so the trajectory
+        of a minibatch does not depend on the updates made before it. Each
+        chunk is projected and run through the recurrence as one block of
+        large GEMMs, and the per-minibatch Vhh/ch updates are then fed from
+        that cache in the usual order.
+        """
+        per_chunk = max(self.g_chunk // self.batch_size, 1)
+        for first in range(0, n_batches, per_chunk):
+            n = min(per_chunk, n_batches - first)
+            start = first * self.batch_size
+            x = self._train_inputs(start, start + n * self.batch_size, "x_chunk")
+            shape = x.shape[:2] + (self.n_hid,)
+
+            xw = self._project(x, out=self.ws.get("xw_chunk", shape))
+            h0 = self.ws.get("h0_chunk", shape[1:])
+            h0[...] = 0
+            h = self._trajectory(xw, h0, self.ws.get("h_chunk", shape))
+
+            for i in range(n):
+                batch = slice(i * self.batch_size, (i + 1) * self.batch_size)
+                self._update_g(x[:, batch], h[:, batch, :], xw[:, batch, :])
+
+    def _step_fused(self, ilr, x, y, mask=None):
+        # one forward pass serves both the feedback and the forward update,
+        # Whh/Wxh/bh are untouched by the g-step so h stays valid for the f-step
+        xw = self._batch_projection(x)
+        h = self._hidden(x, xw, mask)
+        self._update_g(x, h, xw, mask)
+        return self._step_f(ilr, x, y, xw, h, mask=mask)
+
+    def _hidden_horizon(self, x):
+        """
+        Forward pass for a truncated target horizon.
 
-        if self.last_layer == "softmax":
-            cost = self._cross_entropy(out, y)
-        elif self.last_layer == "linear":
-            cost = self._mse(out, y).sum()
-        else:
-            raise Exception("Unsupported classification type.")
+        The first T - horizon - 1 steps are run without storing any state,
+        and only the window x[-(horizon + 1):] is kept: the horizon states
+        plus the state that feeds the first of them.
 
-        error = out - y
-        h_ = self._get_targets(x, hs_tmax, h, cost, ilr, error)
+        Returns
+        -------
+        tuple
+            The window inputs, their projection and their hidden states, each
+            with horizon + 1 timesteps.
+        """
+        window = self.horizon + 1
+        start = len(x) - window
+        shape = (window, x.shape[1], self.n_hid)
+        xw = self.ws.get("xw", shape)
+        h = self.ws.get("h", shape)
+        prefix = self.ws.get("h_prefix", (2,) + shape[1:])
+
+        state = self.h0
+        # the prefix is projected in window-sized blocks through the same buffer
+        for t0 in range(0, start, window):
+            n = min(window, start - t0)
+            self._project(x[t0 : t0 + n], out=xw[:n])
+            for i in range(n):
+                state = self._f(None, state, xw[i], out=prefix[(t0 + i) % 2])
+
+        x = x[start:]
+        self._project(x, out=xw)
+        return x, xw, self._trajectory(xw, state, h)
+
+    def _step_stream(self, ilr, x, y, carry, x_prev):
+        """
+        One feedback and forward update on a chunk of a longer sequence.
+
+        The chunk is run from the hidden state *carry* left by the previous
+        chunk instead of from zeros. The carried state and the last input of
+        the previous chunk, *x_prev*, are prepended as step 0 of the window,
+        so they feed the first step of the chunk like any other previous
+        step but get no target themselves. Both are then advanced to the end
+        of this chunk in place.
+        """
+        shape = (len(x) + 1, x.shape[1])
+        xs = self._input_buffer("stream_x", shape)
+        xs[0] = x_prev
+        xs[1:] = x  # reads the chunk from disk when x is memory-mapped
+        xw = self._project(xs, out=self.ws.get("xw", shape + (self.n_hid,)))
+        h = self.ws.get("h", shape + (self.n_hid,))
+        h[0] = carry
+        self._trajectory(xw[1:], carry, h[1:])
+
+        self._update_g(xs, h, xw)
+        cost = self._step_f(ilr, xs, y, xw, h, first=1)
+        carry[...] = h[-1]
+        x_prev[...] = xs[-1]
+        return cost
 
-        dWhh, dWxh, dbh, dwhy, dby = self._calc_f_grads(x, h, h_, cost, out, y)
+    def _step_f(self, ilr, x, y, xw=None, h=None, first=0, mask=None):
+
+        if h is None and self.horizon:
+            x, xw, h = self._hidden_horizon(x)
+            first = 1
+        elif h is None and (self.checkpoint or self.targets == "inverse"):
+            if self.targets == "inverse":
+                h = InverseTrajectory(self, x, self.h0, self.checkpoint)
+            else:
+                h = CheckpointedTrajectory(self, x, self.h0, self.checkpoint)
+            xw = h.xw
+        elif h is None:
+            xw = self._batch_projection(x)
+            h = self._hidden(x, xw, mask)
+
+        hs_tmax = h[-1]
+        out, cost = self._output_cost(hs_tmax, y)
+        error = self._output_error(out, y)
+        if self.targets != "stored" or self.checkpoint:
+            dWhh, dWxh, dbh, dwhy, dby = self._calc_f_grads_fused(
+                x, h, hs_tmax, ilr, error, out, y, xw, first
+            )
+            if self.targets == "inverse":
+                self.recon_error = h.reconstruction_error()
+        else:
+            h_ = self._get_targets(x, hs_tmax, h, cost, ilr, error, xw, mask)
+            dWhh, dWxh, dbh, dwhy, dby = self._calc_f_grads(x, h, h_, cost, out, y, first)
         self.grad_Whh = dWhh
         self.grad_Wxh = dWxh
         self.grad_bh = dbh
@@ -348,20 +1247,150 @@ class SRNN(object):
         def mem_gaussian(x, _mem_noise):
             # function for adding memristor noise
             return np.random.normal(0, _mem_noise*np.max(x), np.shape(x))
-        self.Whh = self.Whh - self.f_lr * dWhh
-        self.Wxh = self.Wxh - self.f_lr * dWxh
-        self.bh = self.bh - self.f_lr * dbh
-        self.Why = self.Why - self.f_lr * dwhy
-        self.by = self.by - self.f_lr * dby
+        self._update(self.Whh, dWhh, self.f_lr)
+        if self.grad_Wxh_rows is None:
+            self._update(self.Wxh, dWxh, self.f_lr)
+        else:
+            # only the rows of the symbols in the batch have a gradient
+            self._update_rows(self.Wxh, self.grad_Wxh_rows, dWxh, self.f_lr)
+        self._update(self.bh, dbh, self.f_lr)
+        self._update(self.Why, dwhy, self.f_lr)
+        self._update(self.by, dby, self.f_lr)
         return cost
 
+    def _update(self, param, grad, lr):
+        # param -= lr * grad in place, without allocating the scaled gradient
+        step = self.ws.get("update", grad.shape)
+        np.multiply(grad, lr, out=step)
+        param -= step
+
+    def _update_rows(self, param, rows, grad, lr):
+        # param[rows] -= lr * grad for distinct rows, leaving the others alone
+        step = self.ws.get("update", grad.shape)
+        np.multiply(grad, lr, out=step)
+        param[rows] -= step
+
+    def fit_stream(self, ilr, X, y, chunk_length, maxiter=1, check_interval=100):
+        """
+        Trains on a batch of very long sequences that are streamed from disk.
+
+        Parameters
+        ----------
+        ilr            : initial learning rate for the targets
+        X              : inputs of shape (total_length, batch, n_inp), or the
+                         path of a .npy file holding them, which is opened
+                         memory-mapped so only one chunk is read at a time
+        y              : targets of shape (n_chunks * batch, n_out), one
+                         batch of rows per chunk, scored at the chunk's last
+                         step (a path is opened the same way)
+        chunk_length   : number of timesteps per update
+        maxiter        : number of passes over the stream
+        check_interval : number of chunks between progress reports
+
+        Returns
+        -------
+        The mean cost of the last pass.
+
+        The hidden state is carried across chunk boundaries (and reset to
+        zeros at the start of every pass), and every chunk gets one feedback
+        and one forward update, as in the fused schedule. The states of a
+        chunk are always stored, so the inverse targets, checkpoint and
+        horizon are not supported here.
+        """
+        if self.targets == "inverse" or self.checkpoint or self.horizon:
+            raise Exception("Unsupported options for a streamed sequence.")
+        if isinstance(X, str):
+            X = np.load(X, mmap_mode="r")
+        if isinstance(y, str):
+            y = np.load(y, mmap_mode="r")
+
+        batch = X.shape[1]
+        n_chunks = min(X.shape[0] // chunk_length, y.shape[0] // batch)
+        carry = self.ws.get("h_carry", (batch, self.n_hid))
+        x_prev = self._input_buffer("x_carry", (batch,))
+
+        cost = 0
+        for epoch in range(1, maxiter + 1):
+            carry[...] = 0
+            x_prev[...] = 0
+            cost = 0
+            for i in range(n_chunks):
+                x = X[i * chunk_length : (i + 1) * chunk_length]
+                cost += self._step_stream(
+                    ilr, x, y[i * batch : (i + 1) * batch], carry, x_prev
+                )
+                if np.isnan(cost):
+                    print("Cost is NaN. Aborting....")
+                    return cost
+                if (i + 1) % check_interval == 0:
+                    print(
+                        "It: %i\tChunk: %i/%i\tLoss: %.3f"
+                        % (epoch, i + 1, n_chunks, cost / (i + 1))
+                    )
+            cost = cost / max(n_chunks, 1)
+        return cost
+
+    def _minibatches(self):
+        """
+        Yields the training minibatches of an epoch as (x, y, mask).
+
+        A streamed X is read through StreamingDataset.batches, once per
+        call. Otherwise, without lengths these are consecutive batch_size
+        slices of X (or blocks gathered through index) with no mask. With
+        lengths every bucket is gathered into the workspace, trimmed to its
+        longest sequence, together with its mask.
+        """
+        if self.streaming:
+            for x, y in self.X.batches(self.batch_size):
+                yield x, y, None
+            return
+
+        if self.buckets is None:
+            for i in range(self.n_train // self.batch_size):
+                start = i * self.batch_size
+                end = start + self.batch_size
+                x = self._train_inputs(start, end)
+                yield x, self._train_targets(start, end), None
+            return
+
+        for idx in self.buckets:
+            x, mask = self._gather(self.X, self.lengths, idx)
+            yield x, self.y[idx], mask
+
+    def _gather(self, X, lengths, idx):
+        # left-padded sequences idx of X, trimmed to the longest of them
+        T = int(lengths[idx].max())
+        x = self._take(X[len(X) - T :], idx, "x_bucket")
+        return x, self._mask(lengths[idx], T, out=self.ws.get("mask", (T, len(idx), 1)))
+
+    @staticmethod
+    def _mask(lengths, T, out):
+        # 1 on the last lengths[b] of the T steps of sequence b, 0 on its padding
+        np.greater_equal(
+            np.arange(T)[:, None], T - lengths[None, :], out=out[:, :, 0], casting="unsafe"
+        )
+        return out
+
+    def _validate_bucketed(self, x, lengths, index=None, logits=False):
+        # _validate over length buckets, with the outputs (logits if *logits*
+        # is set) in the order of x (or of index)
+        columns = np.arange(x.shape[1]) if index is None else index
+        out = np.empty((len(columns), self.n_out))
+        budget = self.batch_size * self.seq_length
+        for pos in bucket_batches(lengths[columns], budget):
+            xb, mask = self._gather(x, lengths, columns[pos])
+            out[pos] = self._validate(xb, mask, logits=logits)
+        return out
+
     def fit(self, ilr, maxiter, task, rng, glr, flr, check_interval=1):
 
         training = True
         epoch = 1
         best = 0
 
-        n_batches = self.X.shape[1] // self.batch_size
+        n_batches = self.n_train // self.batch_size
+        if self.buckets is not None:
+            n_batches = len(self.buckets)
         accs = []
         while training & (epoch <= maxiter):
 
@@ -375,21 +1404,19 @@ class SRNN(object):
 
             cost = 0
             # Inverse mappings
-            for i in range(n_batches):
-                batch_start_idx = i * self.batch_size
-                batch_end_idx = batch_start_idx + self.batch_size
-                x = self.X[:, batch_start_idx:batch_end_idx, :]
-                y = self.y[batch_start_idx:batch_end_idx, :]
-                self._step_g(x, y)
+            whole_set = self.buckets is None and not self.streaming
+            if self.schedule == "two_pass" and self.g_chunk and whole_set:
+                self._g_phase_chunked(n_batches)
+            elif self.schedule == "two_pass":
+                for x, y, mask in self._minibatches():
+                    self._step_g(x, y, mask)
 
             # Forward mappings
-            for i in range(n_batches):
-                batch_start_idx = i * self.batch_size
-                batch_end_idx = batch_start_idx + self.batch_size
-                x = self.X[:, batch_start_idx:batch_end_idx, :]
-                y = self.y[batch_start_idx:batch_end_idx, :]
-
-                cost += self._step_f(ilr, x, y)
+            for x, y, mask in self._minibatches():
+                if self.schedule == "fused":
+                    cost += self._step_fused(ilr, x, y, mask)
+                else:
+                    cost += self._step_f(ilr, x, y, mask=mask)
                 if np.isnan(cost):
                     print("Cost is NaN. Aborting....")
                     training = False
@@ -437,6 +1464,8 @@ class SRNN(object):
                     best,
                 )
                 print_str += "ρ|val_err|: %.3f\t" % (valid_err * 100)
+                if self.recon_error is not None:
+                    print_str += "Recon.err: %.5f\t" % self.recon_error
                 accs.append(acc)
                 print(print_str)
 
@@ -455,6 +1484,67 @@ class SRNN(object):
         return best, cost.item()
 
 
+def pad_sequences(sequences):
+    """
+    Left-pads variable-length sequences into one array.
+
+    Parameters
+    ----------
+    sequences : list of numpy.ndarray
+        Sequences of shape (length, n_inp), or (length,) symbol indices
+
+    Returns
+    -------
+    tuple
+        The inputs of shape (max_length, n_sequences, n_inp), or
+        (max_length, n_sequences) for symbol indices, with every
+        sequence ending at the last step and zeros before it, and the array
+        of sequence lengths.
+    """
+    lengths = np.array([len(s) for s in sequences])
+    shape = (lengths.max(), len(sequences)) + sequences[0].shape[1:]
+    dtype = sequences[0].dtype if sequences[0].ndim == 1 else np.float32
+    X = np.zeros(shape, dtype)
+    for i, s in enumerate(sequences):
+        X[len(X) - len(s) :, i] = s
+    return X, lengths
+
+
+def bucket_batches(lengths, token_budget, max_batch=None):
+    """
+    Groups sequences of similar length into minibatches.
+
+    Parameters
+    ----------
+    lengths      : lengths of the sequences
+    token_budget : maximum number of padded timesteps in a minibatch
+    max_batch    : optional cap on the number of sequences in a minibatch
+
+    Returns
+    -------
+    list of numpy.ndarray
+        Sequence indices of every minibatch. The sequences are sorted by
+        length (stably, so equal lengths keep their order) and packed
+        greedily while batch size * longest length stays within the budget,
+        so short sequences go into wide batches and long ones into narrow
+        ones. A sequence longer than the budget gets a batch of its own.
+    """
+    order = np.argsort(lengths, kind="stable")
+    batches = []
+    start = 0
+    for i in range(1, len(order) + 1):
+        n = i - start
+        if i < len(order):
+            full = (n + 1) * lengths[order[i]] > token_budget
+            if max_batch is not None:
+                full = full or n == max_batch
+            if not full:
+                continue
+        batches.append(order[start:i])
+        start = i
+    return batches
+
+
 def sample_length(min_length, max_length, rng):
     """
     Computes a sequence length based on the minimal and maximal sequence size.
@@ -497,12 +1587,13 @@ def run_experiment(
     task = "MNIST"
     sample_train = 60000
     sample_test = 10000
-    X, y, X_test, y_test = load_MNIST(
+    X, y, X_test, y_test, idx, idx_test = load_MNIST(
         "mnist_8x8",
-        one_hot=True,
+        one_hot=False,
         norm=False,
         sample_train=sample_train,
         sample_test=sample_test,
+        lazy=True,
     )
     seq = X.shape[0]
     model = SRNN(
@@ -519,13 +1610,15 @@ def run_experiment(
         g_learning_rate,
         f_learning_rate,
         i_learning_rate,
+        index=idx,
+        index_test=idx_test,
     )
 
     print("SRNN TPTT Network")
     print("--------------------")
     print("task name  : %s" % task_name)
-    print("train size : %i" % (X.shape[1]))
-    print("test size  : %i" % (X_test.shape[1]))
+    print("train size : %i" % model.n_train)
+    print("test size  : %i" % (X_test.shape[1] if idx_test is None else len(idx_test)))
     print("batch size : %i" % batch)
     print("T          : %i" % seq)
     print("n_hid      : %i" % hidden)
@@ -551,10 +1644,19 @@ def run_experiment(
     return val_acc, tr_cost
 
 
-def load_MNIST(data_folder, one_hot=False, norm=True, sample_train=0, sample_test=0):
+def load_MNIST(
+    data_folder, one_hot=False, norm=True, sample_train=0, sample_test=0, lazy=False
+):
     """
     Loads, samples (if needed), and one-hot encodes the MNIST data set.
 
+    If data_folder holds the shards written by mnist_generator.py they are
+    memory-mapped directly, and if those were written with --sample_train
+    and --sample_test they already are the sample, so no further sampling
+    is applied. Otherwise the CSV files are parsed once into a
+    binary cache (see mnist_data), and later calls open the cached arrays
+    with np.memmap.
+
     Parameters
     ----------
     data_folder   : location of the MNIST data
@@ -564,56 +1666,66 @@ def load_MNIST(data_folder, one_hot=False, norm=True, sample_train=0, sample_tes
                     will be applied (i.e. 100% of the data is used)
     sample_train  : fraction of the test data to use. if set to 0 no sampling
                     will be applied (i.e. 100% of the data is used)
+    lazy          : if True the images are neither copied nor normalised, and
+                    the samples are returned as index arrays instead (see
+                    the index, index_test and input_scale options of SRNN)
     Returns
     -------
     X_train - Training images. Dimensions are (784, number of samples, 1)
-    y_train - Training labels. Dimensions are (number of samples, 10)
+    y_train - Training labels. Dimensions are (number of samples, 10), or
+              (number of samples,) integer labels without one_hot
     X_test  - Test images. Dimensions are (784, number of samples, 1)
-    y_test  - Test labels. Dimensions are (number of samples, 10)
+    y_test  - Test labels. Dimensions are (number of samples, 10), or
+              (number of samples,) integer labels without one_hot
+
+    With lazy=True, X_train, y_train, X_test and y_test cover the whole data
+    set (X_* memory-mapped from the cache) and are followed by idx_train and
+    idx_test, the sampled columns, or None if no sampling was applied.
     """
-    X_train = np.genfromtxt(
-        "%s/train_X.csv" % data_folder, delimiter=",", dtype=np.float32
-    )
-    y_train = np.asarray(
-        np.fromfile("%s/train_Y.csv" % data_folder, sep="\n"), dtype="int32"
-    )
+    # images come in the (784, number of samples, 1) layout
+    if has_shards(data_folder):
+        X_train, y_train = load_shards(data_folder, "train")
+        X_test, y_test = load_shards(data_folder, "test")
+        index = load_shard_index(data_folder)
+        if index["sample_train"] or index["sample_test"]:
+            print("Using the sample stored in %s" % data_folder)
+            sample_train = sample_test = 0
+    else:
+        X_train = load_csv_cached("%s/train_X.csv" % data_folder, np.float32, sequence=True)
+        y_train = load_csv_cached("%s/train_Y.csv" % data_folder, np.int32)
 
-    X_test = np.genfromtxt(
-        "%s/test_X.csv" % data_folder, delimiter=",", dtype=np.float32
-    )
-    y_test = np.asarray(
-        np.fromfile("%s/test_Y.csv" % data_folder, sep="\n"), dtype="int32"
-    )
+        X_test = load_csv_cached("%s/test_X.csv" % data_folder, np.float32, sequence=True)
+        y_test = load_csv_cached("%s/test_Y.csv" % data_folder, np.int32)
+    idx_train = idx_test = None
     if (sample_train != 0) and (sample_test != 0):
 
         print("Elements in train : %i" % sample_train)
         print("Elements in test  : %i" % sample_test)
 
         idx_train = np.random.choice(
-            np.arange(len(X_train)), sample_train, replace=False
+            np.arange(X_train.shape[1]), sample_train, replace=False
         )
-        idx_test = np.random.choice(np.arange(len(X_test)), sample_test, replace=False)
+        idx_test = np.random.choice(np.arange(X_test.shape[1]), sample_test, replace=False)
 
-        X_train = X_train[idx_train]
+    if idx_train is not None and not lazy:
+        X_train = X_train[:, idx_train]
         y_train = y_train[idx_train]
 
-        X_test = X_test[idx_test]
+        X_test = X_test[:, idx_test]
         y_test = y_test[idx_test]
 
-    if norm:
+    if norm and not lazy:
         print("MNIST NORMALISED!")
-        X_train /= 255.0
-        X_test /= 255.0
-
-    # Swap axes
-    X_train = np.swapaxes(np.expand_dims(X_train, axis=0), 0, 2)
-    X_test = np.swapaxes(np.expand_dims(X_test, axis=0), 0, 2)
+        X_train = X_train / 255.0
+        X_test = X_test / 255.0
 
-    # Encode the target labels
+    # Encode the target labels, one column per label present (SRNN also
+    # takes the integer labels as they are)
     if one_hot:
-        onehot_encoder = OneHotEncoder(sparse_output=False, categories="auto")
-        y_train = onehot_encoder.fit_transform(y_train.reshape(-1, 1))
-        y_test = onehot_encoder.fit_transform(y_test.reshape(-1, 1))
+        y_train = (y_train[:, None] == np.unique(y_train)).astype(np.float64)
+        y_test = (y_test[:, None] == np.unique(y_test)).astype(np.float64)
+    if lazy:
+        return X_train, y_train, X_test, y_test, idx_train, idx_test
     return X_train, y_train, X_test, y_test
 
 